@@ -0,0 +1,61 @@
+'''Single entry point for all scripts of this repository and the command line handling they share.
+
+    python cli.py <command> [arguments of the script]
+
+The arguments, including @config files, are exactly those of the script behind the command. Only the
+script of the given command is loaded, so short commands do not pay for pandas or matplotlib.'''
+
+import sys
+import runpy
+import pathlib
+import argparse
+
+import profiling
+
+# command -> (script, description)
+COMMANDS = {
+    "generate": ("generate_dataset.py", "Generate a random dataset with singular, parent and child genomes."),
+    "list": ("make_seq_list.py", "Write a seqfile list with the files of a directory."),
+    "compare": ("compare.py", "Count k-mers, run the chopper pack modes and evaluate the results."),
+    "multilevel": ("evaluate_multilevel_pack.py", "Run the multilevel pack algorithm and evaluate the results."),
+    "hll": ("evaluate_hll_measurements.py", "Measure the quality of the chopper HyperLogLog implementation."),
+    "materialize": ("materialize_children.py", "Rebuild child genomes that are stored only as vcf files."),
+    "cache": ("hll_cache.py", "Manage a shared cache of HyperLogLog sketches."),
+    "queue": ("job_queue.py", "Work on or submit to a job queue in a shared directory."),
+}
+
+def config_line_to_args(line):
+    '''One argument per line of an @config file. Surrounding whitespace, empty lines and # comments are ignored.'''
+    line = line.strip()
+    return [] if not line or line.startswith("#") else [line]
+
+def make_parser(description):
+    '''Argument parser that reads @config files like all scripts of this repository.'''
+    parser = argparse.ArgumentParser(description=description, fromfile_prefix_chars='@')
+    parser.convert_arg_line_to_args = config_line_to_args
+    return parser
+
+def parse_args(parser):
+    '''Add the options every script has, parse the command line and start profiling if requested.'''
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.start(args)
+    return args
+
+def main(argv):
+    if not argv or argv[0] in ("-h", "--help") or argv[0] not in COMMANDS:
+        if argv and argv[0] not in ("-h", "--help"):
+            print(f"Unknown command: {argv[0]}\n")
+
+        print("usage: python cli.py <command> [arguments]\n\ncommands:")
+        for command, (script, description) in COMMANDS.items():
+            print(f"  {command:<12}{description} ({script})")
+        print("\nUse python cli.py <command> --help for the arguments of a command.")
+        return
+
+    script = pathlib.Path(__file__).resolve().parent / COMMANDS[argv[0]][0]
+    sys.argv = [str(script)] + argv[1:]
+    runpy.run_path(str(script), run_name="__main__")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
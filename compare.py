@@ -1,16 +1,21 @@
 import os
-import argparse
+import math
+import atexit
 import pathlib 
 import time
 import subprocess
 
+import cli
+import hll_cache
+import profiling
+import sharded_count
+
 # timestamp
 t = time.localtime()
 timestamp = f"{t.tm_year}-{t.tm_mon}-{t.tm_mday}_{t.tm_hour}-{t.tm_min}-{ t.tm_sec}"
 
 #################################### configuration ####################################
-parser = argparse.ArgumentParser(description="Count k-mers from files, run different packing algorithms and evaluate results",
-                                 fromfile_prefix_chars='@')
+parser = cli.make_parser("Count k-mers from files, run different packing algorithms and evaluate results")
 
 parser.add_argument("output_dir", help="The directory where all output files are placed.", 
                     type=pathlib.Path)
@@ -21,6 +26,8 @@ parser.add_argument("binary_dir", help="The binary directory of chopper.",
 
 parser.add_argument("-d", "--hll-dir", required=True, help="The dir where the hlls are cached.",
                     type=pathlib.Path)
+parser.add_argument("--hll-cache-size",
+                    help="If given, the hll dir is used as managed cache (see hll_cache.py) with this size limit, e.g. 20G.")
 parser.add_argument("-l", "--log", default=f"{timestamp}_log.txt", help="The name for the log file (not the whole path).")
 parser.add_argument("-b", "--bins", required=True, type=int, help="The number of technical bins for chopper pack.")
 parser.add_argument("-k", "--kmer-size", default=20, type=int, help="The size of the k-mers.")
@@ -30,17 +37,32 @@ parser.add_argument("-s", "--sketch-bits", default=12, type=int,
 parser.add_argument("-m", "--max-ratio", default=0.5, type=float, 
                     help="The maximal cardinality ratio in the clustering intervals (must be < 1).")
 parser.add_argument("-t", "--threads", default=1, type=int, help="The number of threads to use.")
+parser.add_argument("--false-positive-rate", default=0.05, type=float,
+                    help="The false positive rate of the IBFs, used to predict their size.")
+parser.add_argument("--num-hash-functions", default=2, type=int,
+                    help="The number of hash functions of the IBFs, used to predict their size.")
 parser.add_argument("-x", "--no-recount", action='store_true', 
                     help="If given, chopper count is not invoked and kmer_counts.txt from output dir is used.")
 parser.add_argument("-e", "--exclusively-hlls", action='store_true',
                     help="If given, the hll counts are used for chopper pack instead of the eact counts.")
-
-args = parser.parse_args()
+parser.add_argument("--shards", default=1, type=int,
+                    help="Split the seqfile list into this many shards of similar total file size and count them separately.")
+parser.add_argument("--queue-dir", type=pathlib.Path,
+                    help="If given, the count shards are submitted to this shared job queue directory instead of run locally.")
+parser.add_argument("--local-workers", default=0, type=int,
+                    help="The number of queue workers to start on this machine when --queue-dir is given.")
+
+args = cli.parse_args(parser)
 #################################### execution ####################################
 
 if not os.path.isdir(args.output_dir):
     os.mkdir(args.output_dir)
 
+# bits per k-mer of a bloom filter with the given false positive rate and number of hash functions
+bf_scale = - args.num_hash_functions / (
+    math.log(1 - math.exp(math.log(args.false_positive_rate) / args.num_hash_functions))
+)
+
 # setup logging
 log_path = args.output_dir / args.log
 
@@ -62,10 +84,31 @@ print_and_log(
     f"sketch bits: {args.sketch_bits}\n"
     f"max ratio  : {args.max_ratio}\n"
     f"threads    : {args.threads}\n"
+    f"FPR        : {args.false_positive_rate}\n"
+    f"hash funcs : {args.num_hash_functions}\n"
+    f"BF scaling : {bf_scale}\n"
     f"no recount : {args.no_recount}\n"
     f"hll counts : {args.exclusively_hlls}\n"
+    f"shards     : {args.shards}\n"
 )
 
+# with a managed cache, chopper works on a view of the cache with the sketches for this dataset and parameters
+if args.hll_cache_size:
+    cache = hll_cache.HllCache(args.hll_dir, hll_cache.parse_size(args.hll_cache_size))
+    seqfile_lines = hll_cache.read_seqfile_lines(args.seqfile_list_file)
+
+    hll_dir, missing = cache.checkout(seqfile_lines, args.kmer_size, args.sketch_bits)
+
+    # the view must be removed even if a step fails and quits, its hard links would keep evicted sketches alive
+    atexit.register(cache.release, hll_dir)
+
+    if missing and args.no_recount:
+        print_and_log(f"---------- {len(missing)} of {len(seqfile_lines)} sketches are not cached. ----------\n"
+                      f"Compute them with 'python hll_cache.py prewarm' first or run without --no-recount.")
+        quit()
+else:
+    hll_dir = args.hll_dir
+
 def handle_outputs(proc, name, filename):
     '''If the process errored, print the error, else write stdout to a file'''
 
@@ -85,43 +128,116 @@ def handle_outputs(proc, name, filename):
     with open(filename, "w+") as f:
         f.write(message)
 
-def analyze_result(s):
-    '''Find the biggest technical bin from count_HIBF_kmers_based_on_binning output'''
-    maxi, splits, merges, low_level_size = 0, 0, 0, 0
-
-    for line in s.splitlines():
-        split_line = line.split('\t')
+def read_evaluation(evaluation_filename):
+    '''Load count_HIBF_kmers_based_on_binning output as table with the columns bin, kmers and low_level_kmers'''
+    # imported here, so that counting and packing do not wait for pandas
+    import pandas as pd
 
-        if len(split_line) > 1:
-            maxi = max(maxi, int(split_line[1]))
-
-        if "SPLIT_BIN" in split_line[0]:
-            splits += 1
-
-        if "MERGED_BIN" in split_line[0]:
-            merges += 1
-            low_level_size += int(split_line[2])    
-
-    return (maxi, splits, merges, low_level_size)
-
-def run_count(extra_flags, name):
+    with open(evaluation_filename, "r") as f:
+        lines = pd.Series(f.read().splitlines(), dtype=str)
+
+    # the lines have different numbers of columns, only the first three are used
+    columns = lines[lines.str.len() > 0].str.split("\t", n=3, expand=True).reindex(columns=range(3))
+
+    return pd.DataFrame({
+        "bin": columns[0].astype(str),
+        "kmers": pd.to_numeric(columns[1], errors="coerce"),
+        "low_level_kmers": pd.to_numeric(columns[2], errors="coerce"),
+    })
+
+def gini(values):
+    '''Gini coefficient of the values, 0 if all are equal and close to 1 if one value holds everything'''
+    import numpy as np
+
+    values = np.sort(np.asarray(values, dtype=float))
+    if values.size == 0 or values.sum() == 0:
+        return 0.0
+    ranks = np.arange(1, values.size + 1)
+    return float(2 * (ranks * values).sum() / (values.size * values.sum()) - (values.size + 1) / values.size)
+
+def analyze_result(evaluation):
+    '''Statistics of the technical bins from count_HIBF_kmers_based_on_binning output (see read_evaluation)'''
+    bin_types = {
+        "split": evaluation["bin"].str.contains("SPLIT_BIN", regex=False),
+        "merged": evaluation["bin"].str.contains("MERGED_BIN", regex=False),
+    }
+    bin_types["other"] = ~(bin_types["split"] | bin_types["merged"])
+
+    kmers = evaluation["kmers"].dropna()
+    maxi = int(kmers.max()) if len(kmers) else 0
+    mean = float(kmers.mean()) if len(kmers) else 0.0
+    low_level_size = int(evaluation.loc[bin_types["merged"], "low_level_kmers"].sum())
+
+    stats = {
+        "#split bins": int(bin_types["split"].sum()),
+        "#merged bins": int(bin_types["merged"].sum()),
+        "#other bins": int(bin_types["other"].sum()),
+        "largest bin": maxi,
+        "largest bin * #bins": maxi * args.bins,
+        "lower level k-mers (sum)": low_level_size,
+        "sum of the 2 above lines": maxi * args.bins + low_level_size,
+    }
+
+    for name, q in (("min", 0), ("q1", 0.25), ("median", 0.5), ("q3", 0.75)):
+        stats[f"bin k-mers {name}"] = float(kmers.quantile(q)) if len(kmers) else 0.0
+    stats["bin k-mers mean"] = mean
+    stats["bin k-mers std"] = float(kmers.std(ddof=0)) if len(kmers) else 0.0
+
+    stats["load imbalance (max/mean)"] = maxi / mean if mean else 0.0
+    stats["gini coefficient"] = gini(kmers)
+
+    for bin_type, mask in bin_types.items():
+        type_kmers = evaluation.loc[mask, "kmers"].dropna()
+        stats[f"{bin_type} bins k-mers (sum)"] = int(type_kmers.sum())
+        stats[f"{bin_type} bins k-mers (max)"] = int(type_kmers.max()) if len(type_kmers) else 0
+
+    # all technical bins of an IBF have the size of the largest one
+    stats["predicted top level bytes"] = math.ceil(maxi * args.bins * bf_scale / 8)
+    stats["predicted lower level bytes"] = math.ceil(low_level_size * bf_scale / 8)
+    stats["predicted IBF bytes"] = stats["predicted top level bytes"] + stats["predicted lower level bytes"]
+
+    return stats
+
+def format_statistic(value):
+    return f"{value:.4f}" if isinstance(value, float) else str(value)
+
+def run_count(extra_flags, name, hll_dir=None, seqfile_list_file=None):
+    seqfile_list_file = seqfile_list_file or args.seqfile_list_file
     kmer_counts_filename = args.output_dir / (name + "_kmer_counts.txt")
-    
-    start_time = time.perf_counter()
 
-    count_proc = subprocess.run([
+    count_command = [
         args.binary_dir / "chopper", 
         "count",
-        "-f", args.seqfile_list_file,
-        "-o", kmer_counts_filename,
         "-k", str(args.kmer_size),
-        "-t", str(args.threads),
         "-s", str(args.sketch_bits),
         "--disable-minimizers",
-        ] + extra_flags,
-        encoding='utf-8',
-        capture_output=True
-    )
+        ] + extra_flags
+    
+    start_time = time.perf_counter()
+
+    if args.shards > 1:
+        count_proc = sharded_count.run_sharded_count(
+            count_command,
+            seqfile_list_file,
+            kmer_counts_filename,
+            hll_dir,
+            args.shards,
+            args.output_dir / (name + "_count_shards"),
+            args.queue_dir,
+            args.local_workers,
+            args.threads
+        )
+
+    else:
+        count_proc = subprocess.run(
+            count_command + [
+            "-f", seqfile_list_file,
+            "-o", kmer_counts_filename,
+            "-t", str(args.threads),
+            ] + (["-d", hll_dir] if hll_dir else []),
+            encoding='utf-8',
+            capture_output=True
+        )
     
     elapsed_time = time.perf_counter() - start_time
 
@@ -148,7 +264,7 @@ def run_pack(extra_flags, name):
         args.binary_dir / "chopper", 
         "pack",
         "-f", kmer_counts_filename,
-        "-d", args.hll_dir,
+        "-d", hll_dir,
         "-b", str(args.bins),
         "-a", str(args.alpha),
         "-m", str(args.max_ratio),
@@ -194,45 +310,80 @@ def evaluate(name):
     output_filename = args.output_dir / f"count_HIBF_kmers_based_on_binning_{name}_output.txt"
     handle_outputs(proc, f"count_HIBF_kmers_based_on_binning for the {name}", output_filename)
 
-    with open(evaluation_filename, "r") as f:
-        evaluation = f.read()
-
     peak_mem = ""
     for line in proc.stderr.splitlines():
         if "peak memory usage" in line:
             peak_mem = "           " + line + "\n\n"
 
-    maxi, splits, merges, low_level_size = analyze_result(evaluation)
+    with profiling.stage("analyze"):
+        stats = analyze_result(read_evaluation(evaluation_filename))
+
+    width = max(map(len, stats))
     print_and_log(
         f"---------- evaluating with {name} done. ----------\n"
         f"{peak_mem}"
-        f"#split bins              : {splits}\n"
-        f"#merged bins             : {merges}\n"
-        f"largest bin              : {maxi}\n"
-        f"largest bin * #bins      : {maxi * args.bins}\n"
-        f"lower level k-mers (sum) : {low_level_size}\n"
-        f"sum of the 2 above lines : {maxi * args.bins + low_level_size}\n"
-        f"\n{evaluation if len(evaluation.splitlines()) <= 64 else ''}"
-        )
+        + "".join(f"{key:<{width}} : {format_statistic(value)}\n" for key, value in stats.items())
+    )
+
+    return stats
+
+def write_comparison(results):
+    '''Write the statistics of all evaluated runs side by side to comparison.tsv and print them'''
+    names = list(results)
+    rows = [[key] + [format_statistic(results[name][key]) for name in names] for key in results[names[0]]]
+
+    comparison_filename = args.output_dir / "comparison.tsv"
+    with open(comparison_filename, "w+") as f:
+        f.write("\t".join(["statistic"] + names) + "\n")
+        f.writelines("\t".join(row) + "\n" for row in rows)
+
+    widths = [max(len(str(x)) for x in column) for column in zip(["statistic"] + names, *rows)]
+    print_and_log(
+        f"---------- comparison (also in {comparison_filename}) ----------\n\n"
+        + "\n".join(
+            "  ".join(x.ljust(w) if i == 0 else x.rjust(w) for i, (x, w) in enumerate(zip(row, widths)))
+            for row in [["statistic"] + names] + rows
+        ) + "\n"
+    )
 
 if not args.no_recount:
     # run chopper count on the fasta listing
-    run_count([], "exact")
-    run_count(["-e", "-d", str(args.hll_dir)], "hll")
+    with profiling.stage("count exact"):
+        run_count([], "exact")
+    with profiling.stage("count hll"):
+        if not args.hll_cache_size or args.exclusively_hlls:
+            # chopper pack needs the estimates of all files
+            run_count(["-e"], "hll", hll_dir)
+        elif missing:
+            # only the sketches that are not cached yet have to be computed
+            missing_list_file = args.output_dir / "hll_missing_seqfiles.txt"
+            with open(missing_list_file, "w") as f:
+                f.writelines(line + "\n" for line in missing)
+            run_count(["-e"], "hll", hll_dir, missing_list_file)
+        else:
+            print_and_log("---------- All sketches are cached, no hll counting needed. ----------\n")
+
+    if args.hll_cache_size:
+        with profiling.stage("hll cache checkin"):
+            cache.checkin(hll_dir, seqfile_lines, args.kmer_size, args.sketch_bits)
 
 else:
     print_and_log("---------- No recount of k-mers done. ----------\n")
 
 # run chopper pack WITHOUT union estimates
-run_pack([], "reference")
+with profiling.stage("pack reference"):
+    run_pack([], "reference")
 
 # run chopper pack WITH union estimates
-run_pack(["-u"], "union")
+with profiling.stage("pack union"):
+    run_pack(["-u"], "union")
 
 # run chopper pack WITH union estimates AND rearranging
-run_pack(["-u", "-r"], "rearrange")
+with profiling.stage("pack rearrange"):
+    run_pack(["-u", "-r"], "rearrange")
 
 # run count_HIBF_kmers_based_on_binning for the reference, unions and rearrange result
-evaluate("reference"), 
-evaluate("union"), 
-evaluate("rearrange")
+with profiling.stage("evaluate"):
+    results = {name: evaluate(name) for name in ("reference", "union", "rearrange")}
+
+write_comparison(results)
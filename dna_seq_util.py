@@ -1,13 +1,201 @@
+import os
+import sys
+import mmap
 import random 
-from more_itertools import chunked
+import tempfile
 
 def seed(a):
     random.seed(a)
 
+def get_state():
+    '''State of the random generator as a json serializable list.'''
+    version, internal_state, gauss_next = random.getstate()
+    return [version, list(internal_state), gauss_next]
+
+def set_state(state):
+    '''Restore a state obtained with get_state.'''
+    version, internal_state, gauss_next = state
+    random.setstate((version, tuple(internal_state), gauss_next))
+
 def write_random_dna_seq_fasta(length, seq_id, filepath, mode):
     '''Write a random dna sequence with given size to a fasta file with given filename and file mode (a+ or w+).'''
+    # imported here, so that only writing random sequences needs more_itertools
+    from more_itertools import chunked
+
     with open(filepath, mode) as f:
         f.write(">" + seq_id + "\n")
         seq_gen = (random.choice(('A', 'C', 'G', 'T')) for _ in range(length))
         for seq_line in chunked(seq_gen, 80):
-            f.write("".join(seq_line) + "\n")
\ No newline at end of file
+            f.write("".join(seq_line) + "\n")
+
+#################################### indexed fasta access ####################################
+
+# bytes that are scanned at once when counting line breaks, to bound the memory usage for huge sequences
+SCAN_CHUNK_SIZE = 1 << 26
+
+def _count(mm, start, end, sub):
+    return sum(mm[i:min(i + SCAN_CHUNK_SIZE, end)].count(sub) for i in range(start, end, SCAN_CHUNK_SIZE))
+
+def _next_record(mm, pos):
+    '''Position of the next '>' at the start of a line at or after pos, -1 if there is none.'''
+    if pos == 0 and mm[:1] == b">":
+        return 0
+    found = mm.find(b"\n>", max(pos - 1, 0))
+    return -1 if found == -1 else found + 1
+
+def build_fasta_index(fasta_path):
+    '''Build a samtools style index of a fasta file.
+    Returns a list of (name, length, offset, line bases, line width) for every sequence.
+    Like for samtools, all lines of a sequence except the last one must have the same length.'''
+    index = []
+
+    with open(fasta_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return index
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = _next_record(mm, 0)
+
+            while start != -1:
+                header_end = mm.find(b"\n", start)
+                header_end = len(mm) if header_end == -1 else header_end
+                name = mm[start + 1:header_end].split()[0].decode("ascii")
+
+                offset = min(header_end + 1, len(mm))
+                next_start = _next_record(mm, offset)
+                end = len(mm) if next_start == -1 else next_start
+
+                # ignore line breaks and empty lines at the end of the sequence
+                while end > offset and mm[end - 1:end] in (b"\n", b"\r"):
+                    end -= 1
+
+                first_line_end = mm.find(b"\n", offset, end)
+                first_line_end = end if first_line_end == -1 else first_line_end
+                line_bases = len(mm[offset:first_line_end].rstrip(b"\r"))
+                line_width = first_line_end + 1 - offset if first_line_end < end else line_bases + 1
+
+                length = end - offset - _count(mm, offset, end, b"\n") - _count(mm, offset, end, b"\r")
+
+                if line_bases:
+                    num_lines = -(-length // line_bases)
+                    if end - offset != length + (num_lines - 1) * (line_width - line_bases):
+                        raise ValueError(f"{fasta_path}: the lines of sequence {name} have different lengths.")
+
+                index.append((name, length, offset, line_bases, line_width))
+                start = next_start
+
+    return index
+
+def index_path(fasta_path):
+    return f"{fasta_path}.fai"
+
+def load_fasta_index(fasta_path):
+    '''Load the index of a fasta file from the .fai file next to it.
+    If it does not exist or is older than the fasta file, it is built and (if possible) written.'''
+    fai_path = index_path(fasta_path)
+
+    if os.path.exists(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(fasta_path):
+        with open(fai_path, "r") as f:
+            return [
+                (name, int(length), int(offset), int(line_bases), int(line_width))
+                for name, length, offset, line_bases, line_width in (line.rstrip("\n").split("\t")[:5] for line in f)
+            ]
+
+    index = build_fasta_index(fasta_path)
+
+    # write to a temporary file first, other processes might read or write the index at the same time
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fai_path) or ".", suffix=".fai.tmp")
+        with os.fdopen(fd, "w") as f:
+            f.writelines("\t".join(map(str, entry)) + "\n" for entry in index)
+        os.replace(tmp_path, fai_path)
+    except OSError:
+        # e.g. no write permission in the directory of the fasta file
+        pass
+
+    return index
+
+class IndexedFasta:
+    '''Random access to the sequences of a fasta file through a memory map and a .fai index.
+
+    fetch returns regions within a single line as memoryview into the file without copying.
+    These views are only valid while the file is open, release them before closing.'''
+
+    def __init__(self, fasta_path):
+        self.fasta_path = fasta_path
+        self.index = {entry[0]: entry for entry in load_fasta_index(fasta_path)}
+        self.names = list(self.index)
+
+        self._file = open(fasta_path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.index else None
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def length(self, name):
+        return self.index[name][1]
+
+    def fetch(self, name, start=0, end=None):
+        '''Return the bases in [start, end) of a sequence without line breaks (the whole sequence by default).'''
+        _, length, offset, line_bases, line_width = self.index[name]
+
+        start = max(start, 0)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return b""
+
+        first_byte = offset + start // line_bases * line_width + start % line_bases
+        last_byte = offset + (end - 1) // line_bases * line_width + (end - 1) % line_bases
+        view = memoryview(self._mm)[first_byte:last_byte + 1]
+
+        if start // line_bases == (end - 1) // line_bases:
+            return view
+
+        return view.tobytes().translate(None, b"\r\n")
+
+#################################### command line interface ####################################
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("index", "fetch"):
+        print(
+            "usage: python dna_seq_util.py index <fasta file>\n"
+            "       python dna_seq_util.py fetch <fasta file> <name>[:<start>-<end>] ...\n\n"
+            "index builds the .fai index of the file, fetch writes the given sequences or regions as fasta to stdout.\n"
+            "Like for samtools faidx, regions are 1-based and inclusive: seq4:1000-2000 are the bases 1000 to 2000\n"
+            "and seq4:1000 reaches until the end of seq4."
+        )
+        quit()
+
+    if sys.argv[1] == "index":
+        for name, length, *_ in load_fasta_index(sys.argv[2]):
+            print(f"{name}\t{length}")
+
+    else:
+        with IndexedFasta(sys.argv[2]) as fasta:
+            for region in sys.argv[3:]:
+                name, _, interval = region.partition(":")
+                start, _, end = interval.replace(",", "").partition("-")
+
+                # samtools region (1-based, inclusive) to python slice (0-based, end exclusive)
+                seq = fasta.fetch(name, int(start) - 1 if start else 0, int(end) if end else None)
+                sys.stdout.buffer.write(f">{region}\n".encode("ascii"))
+                for i in range(0, len(seq), 80):
+                    sys.stdout.buffer.write(seq[i:i + 80])
+                    sys.stdout.buffer.write(b"\n")
+                del seq
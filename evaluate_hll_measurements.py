@@ -1,19 +1,14 @@
-import argparse
 import pathlib
 import subprocess
 
+import cli
 import dna_seq_util
+import profiling
 
-from more_itertools import interleave
-
-import pandas as pd 
-import matplotlib.pyplot as plt 
-import matplotlib.colors as mcolors
-from matplotlib import rcParams
+# more_itertools, pandas and matplotlib are imported where they are needed, so that e.g. generating sequences starts fast
 
 #################################### command line interface ####################################
-parser = argparse.ArgumentParser(description="Measure quality of the chopper HyperLogLog implementation.",
-                                 fromfile_prefix_chars='@')
+parser = cli.make_parser("Measure quality of the chopper HyperLogLog implementation.")
 
 io = parser.add_argument_group("Input/Output")
 io.add_argument("-o", "--fasta-output", type=pathlib.Path, 
@@ -37,7 +32,21 @@ experiments.add_argument("-b", "--bits", action="append",
 experiments.add_argument("-k", "--kmer-size", default="20", 
     help="The size of the k-mers. Default is 20.")
 
-args = parser.parse_args()
+analysis = parser.add_argument_group("Evaluation")
+analysis.add_argument("-S", "--summary-file", type=pathlib.Path,
+    help="The file for the aggregated boxplot statistics. Default is the tsv file with the ending .summary.tsv.")
+analysis.add_argument("--from-summary", action="store_true",
+    help="If given, the plot is created from an existing summary file instead of the tsv file.")
+analysis.add_argument("-p", "--plot-output", type=pathlib.Path, action="append",
+    help="Adds a file to save the plot to, the format is taken from the ending (e.g. .png or .pdf). "
+         "Can be specified multiple times. Default is the tsv file with the ending .png.")
+analysis.add_argument("--show", action="store_true", help="If given, the plot is also shown in a window.")
+analysis.add_argument("--chunk-size", default=1000000, type=int,
+    help="The number of rows of the tsv file that are processed at once.")
+analysis.add_argument("--relative-accuracy", default=0.005, type=float,
+    help="The relative accuracy of the quantiles that are used for the boxplots.")
+
+args = cli.parse_args(parser)
 
 #################################### sequence generation ####################################
 
@@ -54,11 +63,12 @@ if args.fasta_output:
 
     dna_seq_util.seed(args.seed)
 
-    id = 0
-    for length in args.length:
-        for _ in range(args.number_seqs):
-            dna_seq_util.write_random_dna_seq_fasta(length, f"seq{id}", args.fasta_output, "w+" if id == 0 else "a")
-            id += 1
+    with profiling.stage("sequence generation"):
+        id = 0
+        for length in args.length:
+            for _ in range(args.number_seqs):
+                dna_seq_util.write_random_dna_seq_fasta(length, f"seq{id}", args.fasta_output, "w+" if id == 0 else "a")
+                id += 1
     
     fasta_file = args.fasta_output
 
@@ -76,16 +86,19 @@ if fasta_file:
 
     print("Building HyperLogLog sketches...")
 
-    proc = subprocess.run(
-        [
-            args.chopper_bin / "measure_hyperloglog",
-            "-i", fasta_file,
-            "-o", args.tsv_file,
-            "-k", args.kmer_size
-        ] + list(interleave(["-b"] * len(args.bits), args.bits)),
-        capture_output=True,
-        encoding="utf-8"
-    )
+    from more_itertools import interleave
+
+    with profiling.stage("measure_hyperloglog"):
+        proc = subprocess.run(
+            [
+                args.chopper_bin / "measure_hyperloglog",
+                "-i", fasta_file,
+                "-o", args.tsv_file,
+                "-k", args.kmer_size
+            ] + list(interleave(["-b"] * len(args.bits), args.bits)),
+            capture_output=True,
+            encoding="utf-8"
+        )
 
     if proc.returncode != 0:
         message = (
@@ -105,12 +118,100 @@ print("Doing the evaluation...")
 # sequence_id, sequence_length, sketch_register_size, estimated_cardinality,
 # actual_cardinality, expected_relative_error, actual_relative_error
 
-df = pd.read_csv(
-    args.tsv_file,
-    sep="\t",
-    comment='#',
-    header=0,
-)
+SUMMARY_FIELDS = [
+    "sequence_length", "sketch_register_size", "count", "expected_relative_error",
+    "min", "whisker_low", "q1", "median", "q3", "whisker_high", "max", "mean"
+]
+
+def aggregate_measurements(tsv_file, chunk_size, relative_accuracy):
+    '''Read the measurements in chunks and return a quantile sketch of the actual relative error
+    and the expected relative error for every (sequence length, register size).'''
+    import pandas as pd
+    from quantile_sketch import QuantileSketch
+
+    sketches, expected_errors = {}, {}
+
+    chunks = pd.read_csv(
+        tsv_file,
+        sep="\t",
+        comment='#',
+        header=0,
+        usecols=["sequence_length", "sketch_register_size", "expected_relative_error", "actual_relative_error"],
+        chunksize=chunk_size
+    )
+
+    for chunk in chunks:
+        for key, group in chunk.groupby(["sequence_length", "sketch_register_size"]):
+            key = tuple(int(x) for x in key)
+            if key not in sketches:
+                sketches[key] = QuantileSketch(relative_accuracy)
+                expected_errors[key] = float(group["expected_relative_error"].iloc[0])
+            sketches[key].add(group["actual_relative_error"].to_numpy())
+
+    return sketches, expected_errors
+
+def summarize(sketches, expected_errors):
+    '''Boxplot statistics (like matplotlib, whiskers at 1.5 IQR) for every group.'''
+    summary = []
+    for (seq_length, reg_size), sketch in sorted(sketches.items()):
+        q1, median, q3 = sketch.quantile(0.25), sketch.quantile(0.5), sketch.quantile(0.75)
+        iqr = q3 - q1
+        summary.append({
+            "sequence_length": seq_length,
+            "sketch_register_size": reg_size,
+            "count": sketch.count,
+            "expected_relative_error": expected_errors[(seq_length, reg_size)],
+            "min": sketch.min,
+            "whisker_low": sketch.lowest_at_least(q1 - 1.5 * iqr),
+            "q1": q1,
+            "median": median,
+            "q3": q3,
+            "whisker_high": sketch.highest_at_most(q3 + 1.5 * iqr),
+            "max": sketch.max,
+            "mean": sketch.mean(),
+        })
+    return summary
+
+def write_summary(summary, summary_file):
+    with open(summary_file, "w+") as f:
+        f.write("\t".join(SUMMARY_FIELDS) + "\n")
+        for row in summary:
+            f.write("\t".join(str(row[field]) for field in SUMMARY_FIELDS) + "\n")
+
+def read_summary(summary_file):
+    with open(summary_file, "r") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        return [
+            {field: (int if field in ("sequence_length", "sketch_register_size", "count") else float)(value)
+             for field, value in zip(header, line.rstrip("\n").split("\t"))}
+            for line in f if line.strip()
+        ]
+
+summary_file = args.summary_file or args.tsv_file.with_suffix(".summary.tsv")
+
+if args.from_summary:
+    summary = read_summary(summary_file)
+
+else:
+    with profiling.stage("aggregate tsv"):
+        sketches, expected_errors = aggregate_measurements(args.tsv_file, args.chunk_size, args.relative_accuracy)
+        summary = summarize(sketches, expected_errors)
+
+    write_summary(summary, summary_file)
+    print(f"Wrote the summary to {summary_file}")
+
+#################################### plotting ####################################
+
+with profiling.stage("imports"):
+    import matplotlib
+    # render without a display unless the plot should be shown
+    if not args.show:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt 
+    import matplotlib.colors as mcolors
+
+seq_lengths = sorted({row["sequence_length"] for row in summary})
+reg_sizes = sorted({row["sketch_register_size"] for row in summary})
 
 # font
 plt.rcParams['font.family'] = "CMU Serif"
@@ -120,59 +221,68 @@ plt.rcParams['axes.labelsize'] = large_fonts
 plt.rcParams['ytick.labelsize'] = small_fonts
 plt.rcParams['xtick.labelsize'] = small_fonts
 
-fig = plt.figure()
+fig = plt.figure(figsize=(max(16, 0.8 * len(seq_lengths) * (len(reg_sizes) + 1)), 10))
 ax = plt.gca()
 
-colors = {}
-# add horizontal dotted lines for each register size for the control
-for reg_size, group in df.groupby('sketch_register_size'):
-    
-    # take some color out of the tableau colors and fix it for the given register size
-    colors[reg_size] = list(mcolors.TABLEAU_COLORS.keys())[len(colors)]
+# take some color out of the tableau colors and fix it for the given register size
+tableau_colors = list(mcolors.TABLEAU_COLORS.keys())
+colors = {reg_size: tableau_colors[i % len(tableau_colors)] for i, reg_size in enumerate(reg_sizes)}
 
+# add horizontal dotted lines for each register size for the control
+for reg_size in reg_sizes:
     plt.axhline(
-        y=group['expected_relative_error'].iloc[0], 
+        y=next(row["expected_relative_error"] for row in summary if row["sketch_register_size"] == reg_size), 
         linestyle='dotted',
         label=f"{reg_size} registers/bytes",
         color=colors[reg_size],
         lw=2.5
     )
 
-pos = 1
-last_seq_length = None
-for (seq_length, reg_size), group in df.groupby(['sequence_length','sketch_register_size']):
-
-    # if seq_length changed, we want one empty position for visual seperation
-    if last_seq_length and last_seq_length != seq_length:
-        pos += 1
-    last_seq_length = seq_length
-
-    boxplot = ax.boxplot(
-        group['actual_relative_error'],
-        positions=[pos],
-        labels=['{:.1e}'.format(seq_length)],
-        widths=[0.5]
-    )
+with profiling.stage("boxplots"):
+    pos = 1
+    last_seq_length = None
+    positions = {seq_length: [] for seq_length in seq_lengths}
+    for row in summary:
+        seq_length, reg_size = row["sequence_length"], row["sketch_register_size"]
+
+        # if seq_length changed, we want one empty position for visual seperation
+        if last_seq_length and last_seq_length != seq_length:
+            pos += 1
+        last_seq_length = seq_length
+
+        # the raw values are not kept, so only the extreme values are drawn as outliers, and only if they are
+        # in a bucket beyond the whisker (otherwise the whisker is the extreme value itself)
+        fliers = [x for x in (row["min"], row["max"]) if x < row["whisker_low"] or x > row["whisker_high"]]
+
+        boxplot = ax.bxp(
+            [{
+                "med": row["median"],
+                "q1": row["q1"],
+                "q3": row["q3"],
+                "whislo": row["whisker_low"],
+                "whishi": row["whisker_high"],
+                "fliers": fliers,
+            }],
+            positions=[pos],
+            widths=[0.5]
+        )
 
-    # color the boxplots
-    for lines in boxplot.values():
-        for line in lines:
-            line.set_color(colors[reg_size])
-            line.set_linewidth(2)
+        # color the boxplots
+        for lines in boxplot.values():
+            for line in lines:
+                line.set_color(colors[reg_size])
+                line.set_linewidth(2)
         
-    pos += 1
+        positions[seq_length].append(pos)
+        pos += 1
 
 # labels
-ax.set_ylim(0.0, 0.1)
+ax.set_ylim(0.0, max([0.1] + [1.05 * row["whisker_high"] for row in summary]))
 ax.set_ylabel("Relative error")
 ax.set_xlabel("Sequence length")
 
-num_seq_lengths = df['sequence_length'].nunique()
-num_reg_sizes = df['sketch_register_size'].nunique()
-
-x_ticks = [(num_reg_sizes + 1) / 2 + i * (num_reg_sizes + 1) for i in range(num_seq_lengths)]
-ax.set_xticks(x_ticks)
-ax.set_xticklabels(["100,000", "1,000,000", "10,000,000"])
+ax.set_xticks([sum(p) / len(p) for p in positions.values()])
+ax.set_xticklabels([f"{seq_length:,}" for seq_length in positions])
 
 # axis and background styling
 for spine in ax.spines.values():
@@ -184,4 +294,11 @@ ax.yaxis.grid(True, color='#EEEEEE')
 ax.xaxis.grid(False)
 
 plt.legend(fontsize=small_fonts)
-plt.show()
+
+with profiling.stage("render plot"):
+    for plot_file in args.plot_output or [args.tsv_file.with_suffix(".png")]:
+        fig.savefig(plot_file, bbox_inches="tight")
+        print(f"Wrote the plot to {plot_file}")
+
+    if args.show:
+        plt.show()
@@ -1,4 +1,3 @@
-import argparse
 import subprocess
 import pathlib 
 import os 
@@ -9,7 +8,9 @@ import ast
 import collections
 from enum import Enum 
 
-import pandas as pd
+import cli
+import hll_cache
+import profiling
 
 # TODO
 # FPR adjustment into cardinality estimation
@@ -20,8 +21,7 @@ t = time.localtime()
 timestamp = f"{t.tm_year}-{t.tm_mon}-{t.tm_mday}_{t.tm_hour}-{t.tm_min}-{t.tm_sec}"
 
 #################################### configuration ####################################
-parser = argparse.ArgumentParser(description="Run the multilevel pack algorithm and evaluate the results",
-                                 fromfile_prefix_chars='@')
+parser = cli.make_parser("Run the multilevel pack algorithm and evaluate the results")
 
 parser.add_argument("-o", "--output-dir", required=True, type=pathlib.Path,
                     help="The directory where all output files are placed.")
@@ -29,6 +29,10 @@ parser.add_argument("-k", "--kmer-count-file", required=True, type=pathlib.Path,
                     help="The file for chopper pack in which all sequence files are listed with k-mer counts.")
 parser.add_argument("-c", "--chopper-bin-dir", required=True, type=pathlib.Path, help="The binary directory of chopper.")
 parser.add_argument("-d", "--hll-dir", required=True, help="The dir where the hlls are cached.", type=pathlib.Path)
+parser.add_argument("--hll-cache-size",
+                    help="If given, the hll dir is used as managed cache (see hll_cache.py) with this size limit, e.g. 20G.")
+parser.add_argument("--kmer-size", default=20, type=int, help="The k-mer size of the sketches in the managed hll cache.")
+parser.add_argument("--sketch-bits", default=12, type=int, help="The sketch bits of the sketches in the managed hll cache.")
 parser.add_argument("-n", "--name", default=f"{timestamp}_log.txt", help="The name for the log file (not the whole path).")
 parser.add_argument("-b", "--bins", required=True, type=int, help="The number of technical bins for chopper pack.")
 parser.add_argument("-a", "--alpha", default=1.2, type=float, help="The alpha for the internal binning algorithm.")
@@ -39,7 +43,7 @@ parser.add_argument("-p", "--false-positive-rate", default=0.05, type=float, hel
 parser.add_argument("-s", "--num-hash-functions", default=2, type=int, help="The number hash functions for the IBFs.")
 parser.add_argument("-q", "--quick", action="store_true", help="If given, assume that the binning file already exists.")
 
-args = parser.parse_args()
+args = cli.parse_args(parser)
 
 #################################### execution ####################################
 if not os.path.isdir(args.output_dir):
@@ -78,30 +82,49 @@ binning_filename = args.output_dir / f"{args.name}.binning"
 output_filename = args.output_dir / "pack_multilevel_full_output.txt"
 
 if not args.quick:
+    # with a managed cache, chopper works on a view of the cache with the sketches for this dataset and parameters
+    if args.hll_cache_size:
+        cache = hll_cache.HllCache(args.hll_dir, hll_cache.parse_size(args.hll_cache_size))
+        with open(args.kmer_count_file, "r") as f:
+            lines = [line.split("\t")[0] for line in f if line.strip() and not line.startswith("#")]
+        hll_dir, missing = cache.checkout(lines, args.kmer_size, args.sketch_bits)
+
+        if missing:
+            cache.release(hll_dir)
+            print_and_log(f"---------- {len(missing)} of {len(lines)} sketches are not cached. ----------\n"
+                          f"Compute them with 'python hll_cache.py prewarm' first.")
+            quit()
+    else:
+        hll_dir = args.hll_dir
+
     start_time = time.perf_counter()
 
-    pack_proc = subprocess.run([
-        args.chopper_bin_dir / "chopper", 
-        "pack",
-        "-f", args.kmer_count_file,
-        "-d", args.hll_dir,
-        "-b", str(args.bins),
-        "-a", str(args.alpha),
-        "-m", str(args.max_ratio),
-        "-t", str(args.threads),
-        "-p", str(args.false_positive_rate),
-        "-s", str(args.num_hash_functions),
-        "-u",
-        "-r",
-        "--debug",
-        "-o", binning_filename
-        ],
-        encoding='utf-8',
-        capture_output=True
-    )
+    with profiling.stage("chopper pack"):
+        pack_proc = subprocess.run([
+            args.chopper_bin_dir / "chopper", 
+            "pack",
+            "-f", args.kmer_count_file,
+            "-d", hll_dir,
+            "-b", str(args.bins),
+            "-a", str(args.alpha),
+            "-m", str(args.max_ratio),
+            "-t", str(args.threads),
+            "-p", str(args.false_positive_rate),
+            "-s", str(args.num_hash_functions),
+            "-u",
+            "-r",
+            "--debug",
+            "-o", binning_filename
+            ],
+            encoding='utf-8',
+            capture_output=True
+        )
 
     elapsed_time = time.perf_counter() - start_time
 
+    if args.hll_cache_size:
+        cache.release(hll_dir)
+
     message = (
             f"---------- stdout ----------\n"
             f"{pack_proc.stdout}\n"
@@ -127,13 +150,17 @@ else:
     print_and_log("---------- skipped execution. ----------\n")
 
 #################################### evaluation ####################################
-df = pd.read_csv(
-    binning_filename, 
-    sep="\t", 
-    comment="#", 
-    header=None,
-    names=["File", "Bin_Index", "Num_Bins", "Cardinality_Sum", "Score", "Correction", "T_Max"]
-)
+with profiling.stage("imports"):
+    import pandas as pd
+
+with profiling.stage("read binning"):
+    df = pd.read_csv(
+        binning_filename, 
+        sep="\t", 
+        comment="#", 
+        header=None,
+        names=["File", "Bin_Index", "Num_Bins", "Cardinality_Sum", "Score", "Correction", "T_Max"]
+    )
 
 # represents a technical bin
 class Bin:
@@ -155,22 +182,23 @@ def to_tup(s):
     return tuple(map(ast.literal_eval, s.split(";")))
 
 # extract data from flat df and turn into useful hierarchical structure
-for _, (_, *info) in df.iterrows():
-    infos = tuple(map(to_tup, info))
-
-    curr_level_bins = top_level_bins
-    for level, (bin_index, num_bins, cardi_sum, _, correction, _) in enumerate(zip(*infos)):
-        curr_bin = curr_level_bins[bin_index]
-
-        curr_bin.contained_ubs += 1
-        if curr_bin.contained_ubs > 1:
-            curr_bin.type = Bin.Type.Merged
-            curr_bin.correction = correction
+with profiling.stage("build bin tree"):
+    for _, (_, *info) in df.iterrows():
+        infos = tuple(map(to_tup, info))
+
+        curr_level_bins = top_level_bins
+        for level, (bin_index, num_bins, cardi_sum, _, correction, _) in enumerate(zip(*infos)):
+            curr_bin = curr_level_bins[bin_index]
+
+            curr_bin.contained_ubs += 1
+            if curr_bin.contained_ubs > 1:
+                curr_bin.type = Bin.Type.Merged
+                curr_bin.correction = correction
         
-        curr_bin.cardinality_sum = cardi_sum
-        curr_bin.num_bins = num_bins
+            curr_bin.cardinality_sum = cardi_sum
+            curr_bin.num_bins = num_bins
         
-        curr_level_bins = curr_bin.child_bins
+            curr_level_bins = curr_bin.child_bins
 
 # statistics for a level of the HIBF
 class Statistics():
@@ -232,7 +260,8 @@ def gather_statistics(level, bins):
     stat.s_tech += max_bin_card * local_num_bins
 
 # gather all statistics
-gather_statistics(0, top_level_bins)
+with profiling.stage("gather statistics"):
+    gather_statistics(0, top_level_bins)
 
 #total_space_usage_est = 0
 # print and log statistics for all levels
@@ -2,18 +2,21 @@
 Uses mason2 as subprocess.'''
 
 import os
+import json
+import hashlib
 import subprocess
-import argparse 
 import ast 
 import pathlib 
 
 import math
 
+import cli
 import dna_seq_util
+import materialize_children
+import profiling
 
 #################################### configuration ####################################
-parser = argparse.ArgumentParser(description="Generate random dna sequences with singular genomes and parent genomes with children.",
-                                 fromfile_prefix_chars='@')
+parser = cli.make_parser("Generate random dna sequences with singular genomes and parent genomes with children.")
 
 parser.add_argument("output_dir", help="The directory where all output files are placed.", type=pathlib.Path)
 
@@ -25,8 +28,12 @@ parser.add_argument("-x", "--snp", default=0.001, type=float, help="Snp rate for
 parser.add_argument("-i", "--indel", default=0.00001, type=float, help="Small indel rate for generation of children.")
 parser.add_argument("-r", "--random-seeds", default=None,
                     help="Random seeds to use for all random processes (can be extracted from config_summary.txt of previous runs).")
+parser.add_argument("--lazy-children", action="store_true",
+                    help="If given, children are only stored as vcf files. Use materialize_children.py to rebuild them.")
+parser.add_argument("--resume", action="store_true",
+                    help="If given and the output directory contains a manifest.jsonl of an interrupted run, only missing or corrupted genomes are generated.")
 
-args = parser.parse_args()
+args = cli.parse_args(parser)
 
 OUTPUT_DIR = args.output_dir
 SINGULAR_FASTA_DIR = OUTPUT_DIR / "singular_genomes_fasta/"
@@ -44,25 +51,29 @@ PARENT_GENOME_SIZES = ast.literal_eval(args.parents.strip(' '))
 CHILD_GENOMES_PER_PARENT = args.children
 SNP_RATE = args.snp
 SMALL_INDEL_RATE = args.indel
+LAZY_CHILDREN = args.lazy_children
 
 # seed management
+# the first seed is used for the python random generator, then there is one seed for every child genome
 SEEDS_GIVEN = not args.random_seeds is None
-RANDOM_SEEDS = ast.literal_eval(args.random_seeds.strip(' "')) if SEEDS_GIVEN else []
-seed_index = 0
-
-def next_random():
-    global seed_index
-    # generate new seeds if none were given
-    if not SEEDS_GIVEN:
-        RANDOM_SEEDS.append(int.from_bytes(os.urandom(3), byteorder="big"))
-        return RANDOM_SEEDS[-1]
-    
-    # else use given seeds
-    else:
-        seed_index += 1
-        return RANDOM_SEEDS[seed_index - 1]
-
-dna_seq_util.seed(next_random())
+RANDOM_SEEDS = ast.literal_eval(args.random_seeds.strip(' "')) if SEEDS_GIVEN else [
+    int.from_bytes(os.urandom(3), byteorder="big") for _ in range(1 + CHILD_GENOMES_PER_PARENT * len(PARENT_GENOME_SIZES))
+]
+
+# the manifest is extended as soon as a genome is completed, it is used to resume interrupted runs
+MANIFEST_PATH = OUTPUT_DIR / "manifest.jsonl"
+RESUME = args.resume
+
+CONFIG = {
+    "SINGULAR_GENOME_SIZES": SINGULAR_GENOME_SIZES,
+    "PARENT_GENOME_SIZES": PARENT_GENOME_SIZES,
+    "CHILD_GENOMES_PER_PARENT": CHILD_GENOMES_PER_PARENT,
+    "SNP_RATE": SNP_RATE,
+    "SMALL_INDEL_RATE": SMALL_INDEL_RATE,
+    "RANDOM_SEEDS": RANDOM_SEEDS,
+}
+# normalize tuples to lists so that the config compares equal to the one read from the manifest
+CONFIG = json.loads(json.dumps(CONFIG))
 
 #################################### execution ####################################
 
@@ -74,25 +85,130 @@ def check_error(proc, name):
         print(proc.stderr.decode("utf-8"))
         quit()
 
+def sha256sum(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def file_info(filepath):
+    # paths are stored relative to the output dir, so that the dataset can be moved
+    return {
+        "path": str(filepath.relative_to(OUTPUT_DIR)),
+        "bytes": os.path.getsize(filepath),
+        "sha256": sha256sum(filepath)
+    }
+
+def is_intact(info):
+    '''Check whether a file recorded in the manifest still exists unchanged.'''
+    path = OUTPUT_DIR / info["path"]
+    with profiling.stage("verify finished genomes"):
+        return os.path.isfile(path) and os.path.getsize(path) == info["bytes"] and sha256sum(path) == info["sha256"]
+
+def read_manifest():
+    config, entries = None, {}
+    with open(MANIFEST_PATH, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a crashed run might be incomplete
+                continue
+
+            if not isinstance(record, dict):
+                continue
+            if isinstance(record.get("config"), dict):
+                config = record["config"]
+            elif "name" in record:
+                entries[record["name"]] = record
+
+    return config, entries
+
+def write_manifest(records, mode, manifest_path=MANIFEST_PATH):
+    with open(manifest_path, mode) as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
 # function for well padded filenames
 total_genomes = len(SINGULAR_GENOME_SIZES) + (1 + CHILD_GENOMES_PER_PARENT) * len(PARENT_GENOME_SIZES)
 bits = math.ceil(math.log10(total_genomes))
 number_fmt = lambda i: f'{i:0{bits}d}'
 
+finished = {}
+
+if RESUME and os.path.exists(MANIFEST_PATH):
+    manifest_config, finished = read_manifest()
+
+    if manifest_config is None:
+        # without the configuration (and its random seeds) the finished genomes cannot be trusted
+        print(f"\n{MANIFEST_PATH} has no valid configuration line. Generating the whole dataset again.\n")
+        finished = {}
+
+    else:
+        if SEEDS_GIVEN and manifest_config.get("RANDOM_SEEDS") != RANDOM_SEEDS:
+            print(f"\nThe given random seeds differ from the ones in {MANIFEST_PATH}.\n")
+            quit()
+
+        RANDOM_SEEDS = CONFIG["RANDOM_SEEDS"] = manifest_config.get("RANDOM_SEEDS", RANDOM_SEEDS)
+
+        if manifest_config != CONFIG:
+            print(f"\nThe configuration differs from the one in {MANIFEST_PATH}. Cannot resume.\n")
+            quit()
+
+        print(f"Resuming the dataset generation in {OUTPUT_DIR} ({len(finished)} genomes were finished before).")
+
+    for directory in (SINGULAR_FASTA_DIR, PARENT_FASTA_DIR, CHILD_VCF_DIR, CHILD_FASTA_DIR):
+        os.makedirs(directory, exist_ok=True)
+
+    # rewrite the manifest without incomplete lines
+    write_manifest([{"config": CONFIG}] + list(finished.values()), "w+")
+
 # make sure no other dataset is overwriten
-if os.path.exists(OUTPUT_DIR):
-    print(f"\nThe output directory {OUTPUT_DIR} already exists. Please choose another one or delete the current one.\n")
+elif os.path.exists(OUTPUT_DIR):
+    print(f"\nThe output directory {OUTPUT_DIR} already exists. Please choose another one, delete the current one"
+          f"{' or resume it with --resume' if os.path.exists(MANIFEST_PATH) else ''}.\n")
     quit()
 
-# create all directories
-os.mkdir(OUTPUT_DIR)
-os.mkdir(SINGULAR_FASTA_DIR)
-os.mkdir(PARENT_FASTA_DIR)
-os.mkdir(CHILD_VCF_DIR)
-os.mkdir(CHILD_FASTA_DIR)
+else:
+    # create all directories and the manifest under a temporary name and rename them together,
+    # so that an interrupted run always leaves an output directory that can be resumed
+    tmp_output_dir = OUTPUT_DIR.with_name(f".{OUTPUT_DIR.name}.{os.getpid()}.tmp")
+    os.mkdir(tmp_output_dir)
+    for directory in (SINGULAR_FASTA_DIR, PARENT_FASTA_DIR, CHILD_VCF_DIR, CHILD_FASTA_DIR):
+        os.mkdir(tmp_output_dir / directory.relative_to(OUTPUT_DIR))
+
+    write_manifest([{"config": CONFIG}], "w+", tmp_output_dir / MANIFEST_PATH.relative_to(OUTPUT_DIR))
+    os.rename(tmp_output_dir, OUTPUT_DIR)
 
 fasta_file_listing = ""
-completed_processes = []
+dna_seq_util.seed(RANDOM_SEEDS[0])
+
+def generate_random_genome(name, size, filepath):
+    '''Generate a genome with the python random generator, unless a previous run already did that.'''
+    entry = finished.get(name)
+
+    if entry and is_intact(entry):
+        # continue the random generator as if the genome was just generated
+        dna_seq_util.set_state(entry["rng_state"])
+        return
+
+    # write to a temporary file first, so that there are never incomplete genomes under the final name
+    tmp_filepath = filepath.with_suffix(".tmp.fasta")
+    with profiling.stage("random genomes"):
+        dna_seq_util.write_random_dna_seq_fasta(size, name, tmp_filepath, "w+")
+    os.replace(tmp_filepath, filepath)
+
+    with profiling.stage("manifest"):
+        write_manifest([{
+            "name": name,
+            "seed": RANDOM_SEEDS[0],
+            "size": size,
+            **file_info(filepath),
+            "rng_state": dna_seq_util.get_state(),
+        }], "a")
 
 # generate singular genomes
 for i, size in enumerate(SINGULAR_GENOME_SIZES):
@@ -100,7 +216,7 @@ for i, size in enumerate(SINGULAR_GENOME_SIZES):
     filepath = SINGULAR_FASTA_DIR / (name + ".fasta")
     fasta_file_listing += str(filepath) + '\n'
 
-    dna_seq_util.write_random_dna_seq_fasta(size, name, filepath, "w+")
+    generate_random_genome(name, size, filepath)
 
 parent_filepaths = []
 # generate parent genomes
@@ -110,41 +226,74 @@ for i, size in enumerate(PARENT_GENOME_SIZES):
     parent_filepaths.append(filepath)
     fasta_file_listing += str(filepath) + '\n'
 
-    dna_seq_util.write_random_dna_seq_fasta(size, name, filepath, "w+")
+    generate_random_genome(name, size, filepath)
 
 # create child genomes with mason_variate
 for parent, parent_filepath in enumerate(parent_filepaths):
     for child in range(CHILD_GENOMES_PER_PARENT):
-        vcf_filepath = CHILD_VCF_DIR / ("child_" + number_fmt(parent) + "_" + number_fmt(child) + ".vcf")
-        fasta_filepath = CHILD_FASTA_DIR / ("child_" + number_fmt(parent) + "_" + number_fmt(child) + ".fasta")
+        name = "child_" + number_fmt(parent) + "_" + number_fmt(child)
+        vcf_filepath = CHILD_VCF_DIR / (name + ".vcf")
+        fasta_filepath = CHILD_FASTA_DIR / (name + ".fasta")
+        seed = RANDOM_SEEDS[1 + parent * CHILD_GENOMES_PER_PARENT + child]
 
         fasta_file_listing += str(fasta_filepath) + '\n'
 
-        proc = subprocess.run(
-            [
-            str(MASON_DIR / "mason_variator"), "--verbose",
-            "--seed", str(next_random()),
-            "--snp-rate", str(SNP_RATE),
-            "--small-indel-rate", str(SMALL_INDEL_RATE), 
-            "-ir", str(parent_filepath),
-            "-ov", str(vcf_filepath),
-            "-of", str(fasta_filepath),
-            ],
-            capture_output=True
-        )
+        entry = finished.get(name)
+        if entry and is_intact(entry["vcf"]) and (LAZY_CHILDREN or not entry.get("lazy") and is_intact(entry)):
+            continue
+
+        # mason deduces the formats from the file endings, so the temporary names must keep them
+        tmp_vcf_filepath = vcf_filepath.with_suffix(".tmp.vcf")
+        tmp_fasta_filepath = fasta_filepath.with_suffix(".tmp.fasta")
+
+        with profiling.stage("mason_variator"):
+            proc = subprocess.run(
+                [
+                str(MASON_DIR / "mason_variator"), "--verbose",
+                "--seed", str(seed),
+                "--snp-rate", str(SNP_RATE),
+                "--small-indel-rate", str(SMALL_INDEL_RATE), 
+                "-ir", str(parent_filepath),
+                "-ov", str(tmp_vcf_filepath),
+                ] + ([] if LAZY_CHILDREN else ["-of", str(tmp_fasta_filepath)]),
+                capture_output=True
+            )
 
         check_error(proc, "mason_variate")
-        completed_processes.append(proc)
-
-# write files with mason output and error
-stdout = "".join(map(lambda proc: proc.stdout.decode("ascii"), completed_processes))
-stderr = "".join(map(lambda proc: proc.stderr.decode("ascii"), completed_processes))
-
-with open(OUTPUT_DIR / "mason_stdout.txt", "w+") as f:
-    f.write(stdout)
 
-with open(OUTPUT_DIR / "mason_stderr.txt", "w+") as f:
-    f.write(stderr)
+        # a lazy child must be rebuildable from its vcf, which fails e.g. for structural variants
+        if LAZY_CHILDREN:
+            try:
+                with profiling.stage("check vcf"):
+                    materialize_children.check_child(parent_filepath, tmp_vcf_filepath)
+            except ValueError as e:
+                os.remove(tmp_vcf_filepath)
+                print(f"\n---------- {name} cannot be stored as lazy child: ----------\n\n{e}\n\n"
+                      f"Generate the dataset without --lazy-children.\n")
+                quit()
+
+        os.replace(tmp_vcf_filepath, vcf_filepath)
+        if not LAZY_CHILDREN:
+            os.replace(tmp_fasta_filepath, fasta_filepath)
+
+        # append mason output and error right away, so they are not lost if the run is interrupted
+        with open(OUTPUT_DIR / "mason_stdout.txt", "a+") as f:
+            f.write(proc.stdout.decode("ascii"))
+
+        with open(OUTPUT_DIR / "mason_stderr.txt", "a+") as f:
+            f.write(proc.stderr.decode("ascii"))
+
+        # lazy children only have a vcf file, materialize_children.py finds their parent and vcf here
+        with profiling.stage("manifest"):
+            write_manifest([{
+                "name": name,
+                "seed": seed,
+                "size": PARENT_GENOME_SIZES[parent],
+                **({"lazy": True} if LAZY_CHILDREN else file_info(fasta_filepath)),
+                "fasta_path": str(fasta_filepath.relative_to(OUTPUT_DIR)),
+                "parent": str(parent_filepath.relative_to(OUTPUT_DIR)),
+                "vcf": file_info(vcf_filepath),
+            }], "a")
 
 # write file that lists all generated fasta files
 with open(OUTPUT_DIR / "fasta_file_listing.txt", "w+") as f:
@@ -161,6 +310,7 @@ config_summary = (
     f"CHILD_GENOMES_PER_PARENT = {CHILD_GENOMES_PER_PARENT}\n"
     f"SNP_RATE = {SNP_RATE}\n"
     f"SMALL_INDEL_RATE = {SMALL_INDEL_RATE}\n"
+    f"LAZY_CHILDREN = {LAZY_CHILDREN}\n"
     f"RANDOM_SEEDS = {RANDOM_SEEDS}\n"
     "------------------------------------------------------------------------\n"
 )
@@ -169,3 +319,5 @@ with open(OUTPUT_DIR / "config_summary.txt", "w+") as f:
     f.write(config_summary)
 
 print(f"Succesfully generated the dataset to {OUTPUT_DIR}")
+if LAZY_CHILDREN:
+    print("The children are only stored as vcf files. Use materialize_children.py to rebuild them.")
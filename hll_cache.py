@@ -0,0 +1,264 @@
+'''A size limited cache for the HyperLogLog sketches of chopper that can be shared between experiments.
+
+chopper expects all sketches of a run in one flat directory, named after the user bins. In the cache, every
+sketch is stored under a key made of the identity of its input files (path, size, modification time), the
+k-mer size and the number of sketch bits, so runs with different data or parameters never mix up sketches.
+For a run, a view directory with hard links to the cached sketches is created and passed to chopper.
+New sketches in the view are taken over into the cache afterwards. The modification time of an entry is
+its last access time, if the cache grows larger than its size limit the least recently used entries are removed.
+Views stay valid after eviction because they contain hard links.
+
+Example:
+    python hll_cache.py prewarm /path/to/hll_cache_dir/ /path/to/seqfile_list.txt /path/to/Chopper/build/bin/ -k 20 -s 12'''
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import pathlib
+import subprocess
+import tempfile
+
+import cli
+
+ENTRIES, VIEWS, CONFIG = "entries", "views", "cache_config.json"
+
+# views of runs that crashed are removed after this many seconds
+STALE_VIEW_AGE = 7 * 24 * 60 * 60
+
+def parse_size(s):
+    '''Parse sizes like 500M, 20G or 1024 (bytes).'''
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", str(s), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {s}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit.upper() or " "))
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def read_seqfile_lines(seqfile_list_file):
+    with open(seqfile_list_file, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def line_files(line):
+    return re.split(r"[\t;]", line)
+
+def sketch_name(line):
+    '''Name of the sketch file that chopper writes for a line of the seqfile list.'''
+    return pathlib.Path(line_files(line)[0]).stem + ".hll"
+
+def entry_key(line, kmer_size, sketch_bits):
+    '''Cache key of the sketch of the files in a seqfile line for the given parameters.'''
+    h = hashlib.sha256(f"k={kmer_size};bits={sketch_bits}".encode("utf-8"))
+    for f in line_files(line):
+        stat = os.stat(f)
+        h.update(f"\0{os.path.realpath(f)}\0{stat.st_size}\0{stat.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()[:32]
+
+class HllCache:
+    def __init__(self, cache_dir, max_size=None):
+        '''Open (or create) the cache in cache_dir. If max_size is given, it is stored as new size limit.'''
+        self.cache_dir = pathlib.Path(cache_dir)
+        os.makedirs(self.cache_dir / ENTRIES, exist_ok=True)
+        os.makedirs(self.cache_dir / VIEWS, exist_ok=True)
+
+        config_path = self.cache_dir / CONFIG
+        if max_size is not None:
+            with open(config_path, "w+") as f:
+                json.dump({"max_size": max_size}, f)
+
+        self.max_size = None
+        if os.path.exists(config_path):
+            with open(config_path, "r") as f:
+                self.max_size = json.load(f)["max_size"]
+
+    def entry_path(self, key):
+        # two level layout, so that the directories stay small
+        return self.cache_dir / ENTRIES / key[:2] / f"{key}.hll"
+
+    def entries(self):
+        '''List of (last access time, size, path) of all entries.'''
+        result = []
+        for root, _, filenames in os.walk(self.cache_dir / ENTRIES):
+            for filename in filenames:
+                # in-flight links of checkin are not entries yet
+                if not filename.endswith(".hll"):
+                    continue
+                path = pathlib.Path(root) / filename
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def checkout(self, lines, kmer_size, sketch_bits):
+        '''Create a view directory for chopper with all cached sketches of the seqfile lines.
+        Returns the view directory and the lines without cached sketch.'''
+        view_dir = pathlib.Path(tempfile.mkdtemp(prefix=f"k{kmer_size}_s{sketch_bits}_", dir=self.cache_dir / VIEWS))
+        missing = []
+
+        for line in lines:
+            entry = self.entry_path(entry_key(line, kmer_size, sketch_bits))
+            try:
+                link(entry, view_dir / sketch_name(line))
+                os.utime(entry)
+            except FileNotFoundError:
+                missing.append(line)
+            except FileExistsError:
+                # another line with a sketch of the same name, chopper would mix them up as well
+                pass
+
+        return view_dir, missing
+
+    def checkin(self, view_dir, lines, kmer_size, sketch_bits):
+        '''Take over the sketches that chopper wrote into the view directory and evict if necessary.'''
+        for line in lines:
+            sketch = view_dir / sketch_name(line)
+            if not os.path.exists(sketch):
+                continue
+
+            entry = self.entry_path(entry_key(line, kmer_size, sketch_bits))
+            os.makedirs(entry.parent, exist_ok=True)
+
+            # link under a temporary name first, so that nobody sees a partially copied entry
+            tmp_entry = entry.with_suffix(f".{os.getpid()}.tmp")
+            link(sketch, tmp_entry)
+            os.replace(tmp_entry, entry)
+
+        self.evict()
+
+    def release(self, view_dir):
+        shutil.rmtree(view_dir, ignore_errors=True)
+
+    def evict(self, max_size=None):
+        '''Remove the least recently used entries until the cache is not larger than max_size.
+        Views of crashed runs are removed as well. Returns the number of removed entries.'''
+        for view in os.listdir(self.cache_dir / VIEWS):
+            try:
+                if time.time() - os.path.getmtime(self.cache_dir / VIEWS / view) > STALE_VIEW_AGE:
+                    self.release(self.cache_dir / VIEWS / view)
+            except FileNotFoundError:
+                pass
+
+        max_size = self.max_size if max_size is None else max_size
+        if max_size is None:
+            return 0
+
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        return removed
+
+def link(source, target):
+    '''Hard link source to target, copy if the filesystem does not support hard links.'''
+    try:
+        os.link(source, target)
+    except (FileNotFoundError, FileExistsError):
+        raise
+    except OSError:
+        shutil.copyfile(source, target)
+
+def prewarm(cache, seqfile_list_file, chopper_bin_dir, kmer_size, sketch_bits, threads=1):
+    '''Compute the sketches of all files of the seqfile list that are not cached yet.'''
+    lines = read_seqfile_lines(seqfile_list_file)
+    view_dir, missing = cache.checkout(lines, kmer_size, sketch_bits)
+
+    try:
+        if not missing:
+            return None
+
+        missing_list_file = view_dir / "missing_seqfiles.txt"
+        with open(missing_list_file, "w+") as f:
+            f.write("\n".join(missing) + "\n")
+
+        proc = subprocess.run([
+            chopper_bin_dir / "chopper",
+            "count",
+            "-f", missing_list_file,
+            "-o", view_dir / "kmer_counts.txt",
+            "-k", str(kmer_size),
+            "-t", str(threads),
+            "-s", str(sketch_bits),
+            "--disable-minimizers",
+            "-e",
+            "-d", view_dir
+            ],
+            encoding="utf-8",
+            capture_output=True
+        )
+
+        if proc.returncode == 0:
+            cache.checkin(view_dir, missing, kmer_size, sketch_bits)
+        return proc
+
+    finally:
+        cache.release(view_dir)
+
+#################################### command line interface ####################################
+if __name__ == "__main__":
+    parser = cli.make_parser("Manage a shared, size limited cache of HyperLogLog sketches.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stats_parser = subparsers.add_parser("stats", help="Print size and number of entries of the cache.")
+    stats_parser.add_argument("cache_dir", type=pathlib.Path, help="The cache directory.")
+
+    evict_parser = subparsers.add_parser("evict", help="Set the size limit and remove least recently used entries.")
+    evict_parser.add_argument("cache_dir", type=pathlib.Path, help="The cache directory.")
+    evict_parser.add_argument("max_size", help="The size limit, e.g. 500M or 20G.")
+
+    prewarm_parser = subparsers.add_parser("prewarm", help="Compute all missing sketches of a seqfile list.")
+    prewarm_parser.add_argument("cache_dir", type=pathlib.Path, help="The cache directory.")
+    prewarm_parser.add_argument("seqfile_list_file", type=pathlib.Path, help="The file in which all sequence files are listed.")
+    prewarm_parser.add_argument("binary_dir", type=pathlib.Path, help="The binary directory of chopper.")
+    prewarm_parser.add_argument("-k", "--kmer-size", default=20, type=int, help="The size of the k-mers.")
+    prewarm_parser.add_argument("-s", "--sketch-bits", default=12, type=int,
+                                help="The number of bits to distribute values for the HyperLogLog sketches.")
+    prewarm_parser.add_argument("-t", "--threads", default=1, type=int, help="The number of threads to use.")
+
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        cache = HllCache(args.cache_dir)
+        entries = cache.entries()
+        print(f"entries   : {len(entries)}")
+        print(f"size      : {format_size(sum(size for _, size, _ in entries))}")
+        print(f"size limit: {'none' if cache.max_size is None else format_size(cache.max_size)}")
+
+    elif args.command == "evict":
+        cache = HllCache(args.cache_dir, parse_size(args.max_size))
+        print(f"removed {cache.evict()} entries, the cache now has {format_size(cache.size())}")
+
+    elif args.command == "prewarm":
+        cache = HllCache(args.cache_dir)
+        start_time = time.perf_counter()
+        proc = prewarm(cache, args.seqfile_list_file, args.binary_dir, args.kmer_size, args.sketch_bits, args.threads)
+
+        if proc is None:
+            print("All sketches are cached already.")
+        elif proc.returncode != 0:
+            print(f"chopper count failed with the following output:\nstdout:\n{proc.stdout}\nstderr:\n{proc.stderr}")
+            quit()
+        else:
+            print(f"Computed the missing sketches in {round(time.perf_counter() - start_time, 3)} seconds.")
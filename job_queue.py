@@ -0,0 +1,406 @@
+'''A minimal job queue on top of a shared directory, no broker needed.
+Jobs are json files that move through the subdirectories pending/, running/, done/ and failed/.
+A worker claims a job by atomically renaming it from pending/ to running/, so any number of
+workers on any number of machines can share a queue as long as they see the same filesystem.
+Every claim is a new attempt with its own name (running/<job id>.<attempt>.json), its own heartbeat file
+and its own result directory results/<job id>/<attempt>/. While a job runs, its worker touches the heartbeat
+file. Jobs whose heartbeat is too old belong to a dead worker and are moved back to pending/ by the
+coordinator or by idle workers. A worker only completes the claim it owns, so a stalled worker whose job was
+requeued cannot complete the newer attempt. The job is finished when results/<job id>/result.json exists,
+which is written atomically by the attempt that completed it.
+
+Start a worker with:
+    python job_queue.py worker /shared/queue/dir
+Submit experiment configs and wait for them with:
+    python job_queue.py coordinator /shared/queue/dir compare.py config/a.config config/b.config'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import pathlib
+import itertools
+import threading
+import subprocess
+
+import cli
+
+PENDING, RUNNING, DONE, FAILED, RESULTS = "pending", "running", "done", "failed", "results"
+HEARTBEATS, CONFIGS = "heartbeats", "configs"
+
+# replaced in the arguments of a job with a directory that belongs to the current attempt only
+OUTPUT_DIR_PLACEHOLDER = "{output_dir}"
+
+# seconds between two heartbeats of a running job and seconds after which a job counts as dead
+HEARTBEAT_INTERVAL = 10.0
+HEARTBEAT_TIMEOUT = 60.0
+
+# numbers the claims of this process
+_attempts = itertools.count()
+
+def init_queue(queue_dir):
+    '''Create the subdirectories of the queue if they do not exist yet.'''
+    for sub in (PENDING, RUNNING, DONE, FAILED, RESULTS, HEARTBEATS, CONFIGS):
+        os.makedirs(queue_dir / sub, exist_ok=True)
+
+def new_job_id(name):
+    return f"{time.time_ns()}_{name}_{uuid.uuid4().hex[:8]}"
+
+def submit(queue_dir, argv, name="job", job_id=None, python=False, cwd=None):
+    '''Put a command (list of arguments) into the queue and return the job id.
+    If python is True, the worker runs the command with its own python interpreter.
+    The command is run in cwd, which defaults to the current working directory of the submitter.
+    Arguments can contain OUTPUT_DIR_PLACEHOLDER for outputs that must not be shared between attempts.'''
+    init_queue(queue_dir)
+
+    job_id = job_id or new_job_id(name)
+    job = {
+        "id": job_id,
+        "argv": [str(arg) for arg in argv],
+        "python": python,
+        "cwd": str(cwd or os.getcwd()),
+        "submitted": time.time()
+    }
+
+    # write to a hidden temporary file first so that workers never see half written jobs
+    tmp_path = queue_dir / PENDING / f".{job_id}.tmp"
+    with open(tmp_path, "w+") as f:
+        json.dump(job, f)
+    os.rename(tmp_path, queue_dir / PENDING / f"{job_id}.json")
+
+    return job_id
+
+def submit_config(queue_dir, script, config_file, extra_args=[]):
+    '''Submit a run of a script of this repository with an @-style config file.
+    The config file is copied into the queue, so it can be changed or deleted after submitting.'''
+    init_queue(queue_dir)
+
+    job_id = new_job_id(pathlib.Path(config_file).stem)
+    queued_config = queue_dir / CONFIGS / f"{job_id}.config"
+    shutil.copyfile(config_file, queued_config)
+
+    argv = [pathlib.Path(script).resolve(), f"@{queued_config.resolve()}"] + list(extra_args)
+    return submit(queue_dir, argv, job_id=job_id, python=True)
+
+def new_attempt():
+    '''Name of a new claim of this process, e.g. node1-1234-0 (without dots, see split_claim).'''
+    return f"{socket.gethostname().replace('.', '_')}-{os.getpid()}-{next(_attempts)}"
+
+def split_claim(filename):
+    '''Job id and attempt of a file name <job id>.<attempt>.json in running/.'''
+    job_id, _, attempt = filename[:-len(".json")].rpartition(".")
+    return job_id, attempt
+
+def claim(queue_dir):
+    '''Try to claim the oldest pending job. Returns the job with its attempt or None if the queue is empty.'''
+    for filename in sorted(os.listdir(queue_dir / PENDING)):
+        if not filename.endswith(".json"):
+            continue
+
+        job_id = filename[:-len(".json")]
+        attempt = new_attempt()
+        try:
+            os.rename(queue_dir / PENDING / filename, queue_dir / RUNNING / f"{job_id}.{attempt}.json")
+        except FileNotFoundError:
+            # another worker was faster
+            continue
+
+        beat(queue_dir, job_id, attempt)
+
+        with open(queue_dir / RUNNING / f"{job_id}.{attempt}.json", "r") as f:
+            job = json.load(f)
+        job["attempt"] = attempt
+        return job
+
+    return None
+
+def beat(queue_dir, job_id, attempt):
+    '''Create or refresh the heartbeat file of an attempt.'''
+    heartbeat_path = queue_dir / HEARTBEATS / f"{job_id}.{attempt}"
+    with open(heartbeat_path, "a"):
+        os.utime(heartbeat_path)
+
+def heartbeat_age(queue_dir, job_id, attempt):
+    '''Seconds since the last heartbeat of a running attempt (since it was claimed if there was none yet).'''
+    try:
+        last_beat = os.stat(queue_dir / HEARTBEATS / f"{job_id}.{attempt}").st_mtime
+    except FileNotFoundError:
+        # renaming updates the ctime, so this is the time the job was claimed
+        last_beat = os.stat(queue_dir / RUNNING / f"{job_id}.{attempt}.json").st_ctime
+    return time.time() - last_beat
+
+def requeue_dead(queue_dir, timeout=HEARTBEAT_TIMEOUT):
+    '''Move running jobs without a heartbeat for timeout seconds back to pending/. Returns their ids.'''
+    requeued = []
+
+    for filename in os.listdir(queue_dir / RUNNING):
+        if not filename.endswith(".json"):
+            continue
+
+        job_id, attempt = split_claim(filename)
+        try:
+            if heartbeat_age(queue_dir, job_id, attempt) < timeout:
+                continue
+            os.rename(queue_dir / RUNNING / filename, queue_dir / PENDING / f"{job_id}.json")
+        except FileNotFoundError:
+            # the attempt finished or someone else requeued it in the meantime
+            continue
+
+        try:
+            os.remove(queue_dir / HEARTBEATS / f"{job_id}.{attempt}")
+        except FileNotFoundError:
+            pass
+
+        requeued.append(job_id)
+
+    return requeued
+
+def attempt_dir(queue_dir, job_id, attempt):
+    return queue_dir / RESULTS / job_id / attempt
+
+def run_job(queue_dir, job, heartbeat_interval=HEARTBEAT_INTERVAL):
+    '''Run a claimed job and store its outputs in results/<job id>/<attempt>/.
+    If the claim still belongs to this attempt afterwards, the job is moved to done/ or failed/ and
+    results/<job id>/result.json is published. Else the job was requeued and the outputs are discarded.
+    Returns the result or None if it was discarded.'''
+    job_id, attempt = job["id"], job["attempt"]
+    result_dir = attempt_dir(queue_dir, job_id, attempt)
+    output_dir = result_dir / "output"
+    os.makedirs(output_dir, exist_ok=True)
+
+    argv = ([sys.executable] if job.get("python") else []) + [
+        arg.replace(OUTPUT_DIR_PLACEHOLDER, str(output_dir.absolute())) for arg in job["argv"]
+    ]
+    cwd = job.get("cwd") if os.path.isdir(job.get("cwd") or "") else None
+
+    # keep the heartbeat going in the background while the job runs
+    finished = threading.Event()
+    def keep_beating():
+        while not finished.wait(heartbeat_interval):
+            beat(queue_dir, job_id, attempt)
+    heartbeat_thread = threading.Thread(target=keep_beating, daemon=True)
+    heartbeat_thread.start()
+
+    start_time = time.perf_counter()
+
+    with open(result_dir / "stdout.txt", "w+") as out, open(result_dir / "stderr.txt", "w+") as err:
+        try:
+            returncode = subprocess.run(argv, cwd=cwd, stdout=out, stderr=err).returncode
+        except OSError as e:
+            err.write(f"{e}\n")
+            returncode = 127
+
+    finished.set()
+    heartbeat_thread.join()
+
+    try:
+        os.remove(queue_dir / HEARTBEATS / f"{job_id}.{attempt}")
+    except FileNotFoundError:
+        pass
+
+    result = {
+        "id": job_id,
+        "attempt": attempt,
+        "returncode": returncode,
+        "elapsed": time.perf_counter() - start_time,
+        "worker": f"{socket.gethostname()}:{os.getpid()}",
+    }
+
+    # only the owner of the claim can rename it, a requeued job has a new claim with another name
+    try:
+        os.rename(queue_dir / RUNNING / f"{job_id}.{attempt}.json",
+                  queue_dir / (DONE if returncode == 0 else FAILED) / f"{job_id}.json")
+    except FileNotFoundError:
+        shutil.rmtree(result_dir, ignore_errors=True)
+        return None
+
+    # the result file marks the job as finished, so it must never be seen half written
+    tmp_path = queue_dir / RESULTS / job_id / f".result.{attempt}.tmp"
+    with open(tmp_path, "w+") as f:
+        json.dump(result, f)
+    os.rename(tmp_path, queue_dir / RESULTS / job_id / "result.json")
+
+    return result
+
+def work(queue_dir, poll_interval=1.0, exit_when_empty=False,
+         heartbeat_interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT):
+    '''Worker loop: claim and run jobs until the queue is empty (if exit_when_empty) or forever.
+    The queue only counts as empty if no job is running either, because a running job can still be
+    requeued if its worker dies. An idle worker also requeues the jobs of dead workers.'''
+    init_queue(queue_dir)
+
+    while True:
+        job = claim(queue_dir)
+
+        if job is None:
+            if requeue_dead(queue_dir, timeout):
+                continue
+            if exit_when_empty and not running_jobs(queue_dir):
+                return
+            time.sleep(poll_interval)
+            continue
+
+        run_job(queue_dir, job, heartbeat_interval)
+
+def read_result(queue_dir, job_id):
+    '''Return the result dict of a finished job with its stdout, stderr and output directory.'''
+    with open(queue_dir / RESULTS / job_id / "result.json", "r") as f:
+        result = json.load(f)
+
+    result_dir = attempt_dir(queue_dir, job_id, result["attempt"])
+    with open(result_dir / "stdout.txt", "r") as f:
+        result["stdout"] = f.read()
+    with open(result_dir / "stderr.txt", "r") as f:
+        result["stderr"] = f.read()
+    result["output_dir"] = result_dir / "output"
+
+    return result
+
+def is_finished(queue_dir, job_id):
+    return os.path.exists(queue_dir / RESULTS / job_id / "result.json")
+
+def running_jobs(queue_dir):
+    return [filename for filename in os.listdir(queue_dir / RUNNING) if filename.endswith(".json")]
+
+def pending_age(queue_dir, job_id):
+    '''Seconds since a job was put into pending/ (renaming updates the ctime), 0 if it is not pending.'''
+    try:
+        return time.time() - os.stat(queue_dir / PENDING / f"{job_id}.json").st_ctime
+    except FileNotFoundError:
+        return 0.0
+
+def wait_for(queue_dir, job_ids, poll_interval=1.0, timeout=HEARTBEAT_TIMEOUT, max_wait=None):
+    '''Block until all given jobs are done or failed and return their results in the same order.
+    Meanwhile jobs of dead workers are requeued.
+
+    If nothing is running and a pending job was not claimed for timeout seconds, there is no live worker.
+    Then, or after max_wait seconds (if given), the remaining jobs are given up and reported as failed
+    with returncode -1.'''
+    start_time = time.time()
+    remaining = set(job_ids)
+    gave_up = None
+
+    while remaining:
+        remaining = {job_id for job_id in remaining if not is_finished(queue_dir, job_id)}
+        if not remaining:
+            break
+
+        requeue_dead(queue_dir, timeout)
+
+        if max_wait is not None and time.time() - start_time > max_wait:
+            gave_up = f"gave up after waiting {max_wait} seconds"
+        elif not running_jobs(queue_dir) and max(pending_age(queue_dir, job_id) for job_id in remaining) > timeout:
+            gave_up = f"no worker claimed the job for {timeout} seconds, is any worker running?"
+
+        if gave_up:
+            break
+        time.sleep(poll_interval)
+
+    return [
+        read_result(queue_dir, job_id) if job_id not in remaining else {
+            "id": job_id,
+            "attempt": None,
+            "returncode": -1,
+            "elapsed": 0.0,
+            "worker": "none",
+            "stdout": "",
+            "stderr": f"job {job_id} did not finish: {gave_up}\n",
+            "output_dir": None,
+        }
+        for job_id in job_ids
+    ]
+
+def start_local_workers(queue_dir, number, exit_when_empty=True):
+    '''Start worker processes on this machine. Useful for testing or for using a single node.'''
+    command = [sys.executable, str(pathlib.Path(__file__).resolve()), "worker", str(queue_dir)]
+    if exit_when_empty:
+        command.append("--exit-when-empty")
+
+    return [subprocess.Popen(command) for _ in range(number)]
+
+def status(queue_dir):
+    '''Return the number of jobs in each state.'''
+    return {
+        state: sum(1 for f in os.listdir(queue_dir / state) if f.endswith(".json"))
+        for state in (PENDING, RUNNING, DONE, FAILED)
+    }
+
+#################################### command line interface ####################################
+if __name__ == "__main__":
+    parser = cli.make_parser("Work on or inspect a job queue in a shared directory.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = subparsers.add_parser("worker", help="Claim and run jobs from the queue.")
+    worker_parser.add_argument("queue_dir", type=pathlib.Path, help="The shared queue directory.")
+    worker_parser.add_argument("-p", "--poll-interval", default=1.0, type=float,
+                               help="Seconds to wait before looking for new jobs if the queue is empty.")
+    worker_parser.add_argument("-e", "--exit-when-empty", action="store_true",
+                               help="If given, the worker stops as soon as there are no pending jobs.")
+    worker_parser.add_argument("-b", "--heartbeat-interval", default=HEARTBEAT_INTERVAL, type=float,
+                               help="Seconds between two heartbeats of a running job.")
+    worker_parser.add_argument("-t", "--timeout", default=HEARTBEAT_TIMEOUT, type=float,
+                               help="Seconds without heartbeat after which a job of another worker is requeued.")
+
+    for command, description in (
+        ("submit", "Put runs of a script with the given config files into the queue."),
+        ("coordinator", "Put runs of a script with the given config files into the queue and wait until they are finished.")
+    ):
+        submit_parser = subparsers.add_parser(command, help=description)
+        submit_parser.add_argument("queue_dir", type=pathlib.Path, help="The shared queue directory.")
+        submit_parser.add_argument("script", type=pathlib.Path,
+                                   help="The script to run, e.g. compare.py or evaluate_multilevel_pack.py.")
+        submit_parser.add_argument("config_files", nargs="+", type=pathlib.Path,
+                                   help="The @-style config files. Every file is one job.")
+
+    coordinator_parser = subparsers.choices["coordinator"]
+    coordinator_parser.add_argument("-w", "--local-workers", default=0, type=int,
+                                    help="The number of workers to start on this machine.")
+    coordinator_parser.add_argument("-t", "--timeout", default=HEARTBEAT_TIMEOUT, type=float,
+                                    help="Seconds without heartbeat after which a job is requeued.")
+
+    requeue_parser = subparsers.add_parser("requeue", help="Move jobs of dead workers back into the queue.")
+    requeue_parser.add_argument("queue_dir", type=pathlib.Path, help="The shared queue directory.")
+    requeue_parser.add_argument("-t", "--timeout", default=HEARTBEAT_TIMEOUT, type=float,
+                                help="Seconds without heartbeat after which a job is requeued.")
+
+    status_parser = subparsers.add_parser("status", help="Print the number of jobs in each state.")
+    status_parser.add_argument("queue_dir", type=pathlib.Path, help="The shared queue directory.")
+
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        work(args.queue_dir, args.poll_interval, args.exit_when_empty, args.heartbeat_interval, args.timeout)
+
+    elif args.command in ("submit", "coordinator"):
+        job_ids = [submit_config(args.queue_dir, args.script, config_file) for config_file in args.config_files]
+        for job_id in job_ids:
+            print(f"submitted {job_id}")
+
+        if args.command == "coordinator":
+            workers = start_local_workers(args.queue_dir, args.local_workers)
+            start_time = time.perf_counter()
+
+            results = wait_for(args.queue_dir, job_ids, timeout=args.timeout)
+            for worker in workers:
+                worker.wait()
+
+            print(f"\n---------- all jobs finished after {round(time.perf_counter() - start_time, 3)} seconds ----------\n")
+            for config_file, result in zip(args.config_files, results):
+                print(
+                    f"{str(config_file):<40} returncode {result['returncode']:<4} "
+                    f"took {round(result['elapsed'], 3):>10} seconds on {result['worker']}"
+                )
+            print(f"\nOutputs are in {args.queue_dir / RESULTS}")
+
+    elif args.command == "requeue":
+        init_queue(args.queue_dir)
+        for job_id in requeue_dead(args.queue_dir, args.timeout):
+            print(f"requeued {job_id}")
+
+    elif args.command == "status":
+        init_queue(args.queue_dir)
+        for state, count in status(args.queue_dir).items():
+            print(f"{state:<8}: {count}")
@@ -1,29 +1,33 @@
 import os 
-import argparse
 import random 
 import pathlib 
 
-parser = argparse.ArgumentParser(description="Generate a file with the names of all files inside a folder. Needed for chopper pack.",
-                                 fromfile_prefix_chars='@')
+import cli
+import profiling
+
+parser = cli.make_parser("Generate a file with the names of all files inside a folder. Needed for chopper pack.")
 
 parser.add_argument("data_dir", help="The directory where the files are stored.", type=pathlib.Path)
 parser.add_argument("out_file", help="The location where the output file should be created", type=pathlib.Path)
 parser.add_argument("-m", "--max-number", type=int, default=1000000000000, 
                     help="The maximum number of files to include in the list. If not all are included, the subset is picked at random.")
 
-args = parser.parse_args()
+args = cli.parse_args(parser)
 
-file_list = os.listdir(args.data_dir)
-random.shuffle(file_list)
+with profiling.stage("make listing"):
+    # skip the .fai index files that dna_seq_util places next to fasta files
+    file_list = [f for f in os.listdir(args.data_dir) if not f.endswith(".fai")]
+    random.shuffle(file_list)
 
-if len(file_list) <= args.max_number:
-    full_paths = map(lambda f: str(args.data_dir / f), file_list)
-    seq_listing = "\n".join(full_paths)
+    if len(file_list) <= args.max_number:
+        full_paths = map(lambda f: str(args.data_dir / f), file_list)
+        seq_listing = "\n".join(full_paths)
 
-else:
-    seq_listing = ""
-    for filename in file_list[:args.max_number]:
-        seq_listing += str(args.data_dir / filename)  + "\n"
+    else:
+        seq_listing = ""
+        for filename in file_list[:args.max_number]:
+            seq_listing += str(args.data_dir / filename)  + "\n"
 
-with open(args.out_file , "w+") as f:
-    f.write(seq_listing)
+with profiling.stage("write listing"):
+    with open(args.out_file , "w+") as f:
+        f.write(seq_listing)
@@ -0,0 +1,307 @@
+'''Rebuild child genomes of a dataset from their vcf files and the memory mapped parent genomes.
+Needed for datasets that were generated with generate_dataset.py --lazy-children, where only the vcf files
+of the children are stored. The children can be written to disk permanently or only for the duration of a
+command, either as temporary files or as named pipes.
+
+Examples:
+    python materialize_children.py write /path/to/dataset/
+    python materialize_children.py run /path/to/dataset/ -- chopper count -f {} -o counts.txt'''
+
+import os
+import sys
+import json
+import pathlib
+import time
+import tempfile
+import threading
+import subprocess
+
+import cli
+import dna_seq_util
+
+def read_vcf(vcf_path):
+    '''Return the variants of the first haplotype of a vcf file as dict: contig -> sorted list of (pos, ref, alt).
+    pos is 0-based.'''
+    variants = {}
+
+    with open(vcf_path, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+
+            fields = line.rstrip("\n").split("\t")
+            chrom, pos, ref, alts = fields[0], int(fields[1]) - 1, fields[3], fields[4].split(",")
+
+            # without genotype information the first alternative is used
+            allele = 1
+            if len(fields) > 9:
+                genotype = fields[9].split(":")[0].replace("/", "|").split("|")[0]
+                if genotype in (".", "0"):
+                    continue
+                allele = int(genotype)
+
+            alt = alts[allele - 1]
+            if alt.startswith("<") or "[" in alt or "]" in alt:
+                raise ValueError(f"{vcf_path}: structural variant {alt} at {chrom}:{pos + 1} is not supported.")
+
+            variants.setdefault(chrom, []).append((pos, ref.encode("ascii"), alt.encode("ascii")))
+
+    for contig_variants in variants.values():
+        contig_variants.sort()
+
+    return variants
+
+# bases of the parent that are fetched at once, so that the memory usage does not depend on the genome size
+BLOCK_SIZE = 1 << 20
+
+# same line length as dna_seq_util.write_random_dna_seq_fasta
+LINE_WIDTH = 80
+
+# seconds to wait for the writers of named pipes after the command finished
+WRITER_GRACE_PERIOD = 1.0
+
+def check_variants(parent, seq_id, variants, name=""):
+    '''Make sure that the sorted (pos, ref, alt) variants do not overlap and match the parent sequence.'''
+    prev = 0
+    for pos, ref, _ in variants:
+        if pos < prev:
+            raise ValueError(f"{name}: overlapping variants at position {pos + 1}.")
+        if bytes(parent.fetch(seq_id, pos, pos + len(ref))) != ref:
+            raise ValueError(f"{name}: reference allele at position {pos + 1} does not match the parent.")
+        prev = pos + len(ref)
+
+def child_pieces(parent, seq_id, variants):
+    '''Yield the sequence of a child piece by piece: the unchanged parts of the parent in blocks of at most
+    BLOCK_SIZE bases and the alternative alleles of the variants in between.'''
+    prev = 0
+    for pos, ref, alt in variants + [(parent.length(seq_id), b"", b"")]:
+        for start in range(prev, pos, BLOCK_SIZE):
+            # copied, so that no view into the memory map outlives the parent file
+            yield bytes(parent.fetch(seq_id, start, min(start + BLOCK_SIZE, pos)))
+        yield alt
+        prev = pos + len(ref)
+
+def write_lines(out, pieces):
+    '''Write the concatenation of the pieces to out in lines of LINE_WIDTH bases.'''
+    rest = b""
+    for piece in pieces:
+        buffer = rest + piece
+        full = len(buffer) - len(buffer) % LINE_WIDTH
+        if full:
+            out.write(b"\n".join(buffer[i:i + LINE_WIDTH] for i in range(0, full, LINE_WIDTH)) + b"\n")
+        rest = buffer[full:]
+
+    if rest:
+        out.write(rest + b"\n")
+
+def check_child(parent_fasta, vcf_path):
+    '''Make sure that the child described by vcf_path can be rebuilt from the parent and return its variants.
+    Raises ValueError otherwise.'''
+    variants = read_vcf(vcf_path)
+    name = pathlib.Path(vcf_path).stem
+
+    with dna_seq_util.IndexedFasta(parent_fasta) as parent:
+        for seq_id in parent:
+            check_variants(parent, seq_id, variants.get(seq_id, []), f"{name} {seq_id}")
+
+    return variants
+
+def materialize(parent_fasta, vcf_path, output):
+    '''Write the child described by vcf_path to output (a path or a binary file object).
+    The child is streamed from the memory mapped parent, it is never held in memory as a whole.'''
+    # check all variants first, so that no incomplete child is written
+    variants = check_child(parent_fasta, vcf_path)
+    name = pathlib.Path(vcf_path).stem
+
+    with dna_seq_util.IndexedFasta(parent_fasta) as parent:
+        out = open(output, "wb") if not hasattr(output, "write") else output
+        try:
+            for seq_id in parent:
+                header = name if len(parent) == 1 else f"{name}_{seq_id}"
+                out.write(b">" + header.encode("ascii") + b"\n")
+                write_lines(out, child_pieces(parent, seq_id, variants.get(seq_id, [])))
+        finally:
+            if out is not output:
+                out.close()
+
+def read_manifest(dataset_dir):
+    '''Return the genome records of the manifest of a dataset.'''
+    records = []
+
+    with open(dataset_dir / "manifest.jsonl", "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            if isinstance(record, dict) and "name" in record:
+                records.append(record)
+
+    return records
+
+def lazy_children(dataset_dir):
+    '''Return a dict: child fasta path -> (parent fasta path, vcf path) of all children stored only as vcf.'''
+    return {
+        str(dataset_dir / record["fasta_path"]): (dataset_dir / record["parent"], dataset_dir / record["vcf"]["path"])
+        for record in read_manifest(dataset_dir) if record.get("lazy")
+    }
+
+def write_children(dataset_dir, output_dir=None):
+    '''Materialize all missing children of a dataset into their place in the dataset or into output_dir.'''
+    for fasta_path, (parent_fasta, vcf_path) in lazy_children(dataset_dir).items():
+        target = pathlib.Path(fasta_path) if output_dir is None else output_dir / pathlib.Path(fasta_path).name
+        os.makedirs(target.parent, exist_ok=True)
+        if os.path.exists(target):
+            continue
+
+        tmp_target = target.with_suffix(".tmp.fasta")
+        materialize(parent_fasta, vcf_path, tmp_target)
+        os.replace(tmp_target, target)
+        print(f"wrote {target}")
+
+def dataset_path(path, dataset_dir, genome_paths):
+    '''Return the path in dataset_dir of a genome listed as path, or None if it does not belong to the dataset.
+    generate_dataset.py lists the genomes with the output directory as it was given, so the listed paths can be
+    relative to another working directory. They are therefore matched by their path inside the dataset.'''
+    parts = pathlib.PurePath(path).parts
+    for length in {len(genome_path) for genome_path in genome_paths}:
+        if tuple(parts[-length:]) in genome_paths:
+            in_dataset = dataset_dir.joinpath(*parts[-length:])
+            # an existing file with the same name that belongs to another dataset
+            if os.path.exists(path) and os.path.realpath(path) != os.path.realpath(in_dataset):
+                return None
+            return in_dataset
+    return None
+
+def run_with_children(dataset_dir, command, listing_file=None, tmp_dir=None, pipes=False):
+    '''Run command while all lazy children of the dataset exist as temporary files or named pipes.
+    Every {} in command is replaced by a seqfile list in which the children point to these temporary files.
+    Named pipes need no disk space, but only work if the command reads every file exactly once.'''
+    children = lazy_children(dataset_dir)
+    genome_paths = {
+        pathlib.PurePath(record.get("fasta_path") or record["path"]).parts for record in read_manifest(dataset_dir)
+    }
+    listing_file = listing_file or dataset_dir / "fasta_file_listing.txt"
+
+    # resolve all paths before anything is materialized, so that errors come up front
+    listing, missing_children = [], []
+    with open(listing_file, "r") as f:
+        for line in f:
+            path = line.strip()
+            if not path:
+                continue
+
+            in_dataset = dataset_path(path, dataset_dir, genome_paths)
+            if in_dataset is None:
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"{path} from {listing_file} does not exist and is not part of {dataset_dir}.")
+                listing.append(path)
+
+            elif os.path.exists(in_dataset):
+                listing.append(str(in_dataset))
+
+            elif str(in_dataset) in children:
+                missing_children.append((len(listing), str(in_dataset)))
+                listing.append(None)
+
+            else:
+                raise FileNotFoundError(f"{path} from {listing_file} is missing in {dataset_dir} and cannot be rebuilt.")
+
+    # check all children before any pipe exists, a writer that fails before opening its pipe blocks the command
+    for _, path in missing_children:
+        check_child(*children[path])
+
+    writers, errors = [], []
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        tmp = pathlib.Path(tmp)
+
+        for i, path in missing_children:
+            parent_fasta, vcf_path = children[path]
+            tmp_path = tmp / pathlib.Path(path).name
+            listing[i] = str(tmp_path)
+
+            if pipes:
+                os.mkfifo(tmp_path)
+                writer = threading.Thread(target=write_pipe, args=(parent_fasta, vcf_path, tmp_path, errors), daemon=True)
+                writer.start()
+                writers.append(writer)
+            else:
+                materialize(parent_fasta, vcf_path, tmp_path)
+
+        tmp_listing = tmp / "seqfile_list.txt"
+        with open(tmp_listing, "w+") as f:
+            f.write("\n".join(listing) + "\n")
+
+        proc = subprocess.run([arg.replace("{}", str(tmp_listing)) for arg in command])
+
+    # writers of pipes that the command never opened stay blocked, so they are not waited for long
+    deadline = time.monotonic() + WRITER_GRACE_PERIOD
+    for writer in writers:
+        writer.join(max(0.0, deadline - time.monotonic()))
+
+    if errors:
+        print("\n".join(f"Materializing failed: {error}" for error in errors), file=sys.stderr)
+        return proc.returncode or 1
+
+    return proc.returncode
+
+def write_pipe(parent_fasta, vcf_path, pipe_path, errors):
+    '''Materialize a child into a named pipe, errors are appended to the list errors.
+    The pipe is always closed, so that the command sees the end of the file even if writing failed.'''
+    try:
+        # opening a named pipe for writing blocks until the command opens it for reading
+        with open(pipe_path, "wb") as out:
+            materialize(parent_fasta, vcf_path, out)
+    except BrokenPipeError:
+        # the command stopped reading early
+        pass
+    except Exception as e:
+        errors.append(f"{pipe_path.name}: {e}")
+
+#################################### command line interface ####################################
+if __name__ == "__main__":
+    parser = cli.make_parser("Materialize child genomes that are stored only as vcf files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    write_parser = subparsers.add_parser("write", help="Write all missing child fasta files.")
+    write_parser.add_argument("dataset_dir", type=pathlib.Path, help="The output directory of generate_dataset.py.")
+    write_parser.add_argument("-o", "--output-dir", type=pathlib.Path,
+                              help="If given, the children are written here instead of into the dataset.")
+
+    single_parser = subparsers.add_parser("single", help="Write a single child from a parent and a vcf file.")
+    single_parser.add_argument("parent_fasta", type=pathlib.Path, help="The fasta file of the parent.")
+    single_parser.add_argument("vcf", type=pathlib.Path, help="The vcf file of the child.")
+    single_parser.add_argument("output", type=pathlib.Path, help="The fasta file to write.")
+
+    run_parser = subparsers.add_parser("run",
+        help="Run a command while the children exist temporarily. {} in the command is replaced by a seqfile list.")
+    run_parser.add_argument("dataset_dir", type=pathlib.Path, help="The output directory of generate_dataset.py.")
+    run_parser.add_argument("-l", "--listing", type=pathlib.Path,
+                            help="The seqfile list to use. Default is fasta_file_listing.txt of the dataset.")
+    run_parser.add_argument("-d", "--tmp-dir", type=pathlib.Path, help="Where to place the temporary files.")
+    run_parser.add_argument("-p", "--pipes", action="store_true",
+                            help="Use named pipes instead of temporary files. Every file must be read exactly once.")
+
+    # everything after -- is the command for the run mode
+    argv = sys.argv[1:]
+    cmd = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    if args.command == "write":
+        write_children(args.dataset_dir, args.output_dir)
+
+    elif args.command == "single":
+        materialize(args.parent_fasta, args.vcf, args.output)
+
+    elif args.command == "run":
+        if not cmd:
+            print("Must specify a command to run after --.")
+            quit()
+        try:
+            returncode = run_with_children(args.dataset_dir, cmd, args.listing, args.tmp_dir, args.pipes)
+        except (ValueError, FileNotFoundError) as e:
+            print(f"Cannot run the command: {e}", file=sys.stderr)
+            returncode = 1
+        sys.exit(returncode)
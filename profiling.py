@@ -0,0 +1,187 @@
+'''Opt-in profiling for the scripts of this repository.
+
+Every script gets the --profile option with add_arguments and wraps its steps in named stages:
+
+    with profiling.stage("chopper pack"):
+        ...
+
+Without --profile a stage costs nothing. With --profile DIR, the wall time, the cpu time of python and the cpu
+time of finished subprocesses are measured for every stage and written to DIR/stages.tsv. Optionally
+cProfile (DIR/profile.pstats), tracemalloc (allocations per stage) and a stack sampler (DIR/stacks.collapsed,
+input for flamegraph.pl or speedscope) can be enabled. Time spent waiting for subprocesses shows up as
+[subprocess] in the sampled stacks.'''
+
+import os
+import sys
+import time
+import atexit
+import threading
+import contextlib
+
+# seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+
+_profiler = None
+
+def add_arguments(parser):
+    group = parser.add_argument_group("Profiling")
+    group.add_argument("--profile", type=os.path.abspath, metavar="DIR",
+        help="If given, the time of every stage is measured and a report is written to this directory.")
+    group.add_argument("--profile-cprofile", action="store_true",
+        help="With --profile, also run cProfile and write profile.pstats.")
+    group.add_argument("--profile-tracemalloc", action="store_true",
+        help="With --profile, also measure python memory allocations per stage (slows python code down).")
+    group.add_argument("--profile-stacks", action="store_true",
+        help="With --profile, sample the python stack and write stacks.collapsed for flamegraphs.")
+
+def start(args):
+    '''Start profiling if --profile was given. The report is written when the script exits.'''
+    global _profiler
+    if getattr(args, "profile", None) and _profiler is None:
+        _profiler = Profiler(args.profile, args.profile_cprofile, args.profile_tracemalloc, args.profile_stacks)
+        atexit.register(_profiler.finish)
+
+@contextlib.contextmanager
+def stage(name):
+    '''Measure everything inside the with block as stage with the given name. Stages can be nested.'''
+    if _profiler is None:
+        yield
+        return
+
+    _profiler.enter(name)
+    try:
+        yield
+    finally:
+        _profiler.exit()
+
+class StageStatistics:
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.python_cpu = 0.0
+        self.subprocess_cpu = 0.0
+        self.alloc_peak = 0
+        self.alloc_net = 0
+
+class Profiler:
+    def __init__(self, output_dir, use_cprofile, use_tracemalloc, sample_stacks):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.stages = {}
+        self.open_stages = []
+        self.start_time = time.perf_counter()
+
+        self.cprofile = None
+        if use_cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+        self.tracemalloc = None
+        if use_tracemalloc:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            tracemalloc.start()
+
+        self.stacks = {}
+        self.sampler = None
+        if sample_stacks:
+            self.stop_sampling = threading.Event()
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+
+    def snapshot(self):
+        times = os.times()
+        return {
+            "wall": time.perf_counter(),
+            "python_cpu": time.process_time(),
+            "subprocess_cpu": times.children_user + times.children_system,
+            "memory": self.tracemalloc.get_traced_memory()[0] if self.tracemalloc else 0,
+            "peak": 0,
+        }
+
+    def enter(self, name):
+        path = "/".join([s["name"] for s in self.open_stages] + [name])
+        # reset_peak is only available since python 3.9, before that the peaks include earlier stages
+        if self.tracemalloc and hasattr(self.tracemalloc, "reset_peak"):
+            self.tracemalloc.reset_peak()
+        self.open_stages.append({"name": name, "path": path, **self.snapshot()})
+
+    def exit(self):
+        begin = self.open_stages.pop()
+        end = self.snapshot()
+
+        stat = self.stages.setdefault(begin["path"], StageStatistics())
+        stat.calls += 1
+        stat.wall += end["wall"] - begin["wall"]
+        stat.python_cpu += end["python_cpu"] - begin["python_cpu"]
+        stat.subprocess_cpu += end["subprocess_cpu"] - begin["subprocess_cpu"]
+
+        if self.tracemalloc:
+            # nested stages reset the peak, so their peaks are passed on to the enclosing stage
+            peak = max(self.tracemalloc.get_traced_memory()[1], begin["peak"])
+            stat.alloc_peak = max(stat.alloc_peak, peak - begin["memory"])
+            stat.alloc_net += end["memory"] - begin["memory"]
+            if self.open_stages:
+                self.open_stages[-1]["peak"] = max(self.open_stages[-1]["peak"], peak)
+
+    def sample(self):
+        main_thread_id = threading.main_thread().ident
+
+        while not self.stop_sampling.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(main_thread_id)
+
+            frames = []
+            while frame is not None:
+                frames.append(frame)
+                frame = frame.f_back
+
+            names = [f"stage {s['name']}" for s in list(self.open_stages)]
+            for frame in reversed(frames):
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                if filename == "subprocess.py":
+                    names.append("[subprocess]")
+                    break
+                names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+
+            key = ";".join(names)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def finish(self):
+        total_wall = time.perf_counter() - self.start_time
+
+        if self.sampler:
+            self.stop_sampling.set()
+            self.sampler.join()
+            with open(os.path.join(self.output_dir, "stacks.collapsed"), "w+") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(os.path.join(self.output_dir, "profile.pstats"))
+
+        # close stages that were left open by quit()
+        while self.open_stages:
+            self.exit()
+
+        header = ["stage", "calls", "wall_s", "python_cpu_s", "subprocess_cpu_s"]
+        if self.tracemalloc:
+            header += ["alloc_peak_bytes", "alloc_net_bytes"]
+
+        rows = []
+        for path, stat in self.stages.items():
+            row = [path, stat.calls, f"{stat.wall:.3f}", f"{stat.python_cpu:.3f}", f"{stat.subprocess_cpu:.3f}"]
+            if self.tracemalloc:
+                row += [stat.alloc_peak, stat.alloc_net]
+            rows.append(row)
+
+        with open(os.path.join(self.output_dir, "stages.tsv"), "w+") as f:
+            f.write("\t".join(header) + "\n")
+            f.writelines("\t".join(map(str, row)) + "\n" for row in rows)
+
+        widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+        print(f"\n---------- profile (total {total_wall:.3f} seconds, report in {self.output_dir}) ----------\n")
+        for row in [header] + rows:
+            print("  ".join(str(x).ljust(w) if i == 0 else str(x).rjust(w) for i, (x, w) in enumerate(zip(row, widths))))
@@ -0,0 +1,108 @@
+'''A mergeable quantile sketch with relative accuracy, following the idea of DDSketch.
+
+Values are counted in logarithmically sized buckets, so every quantile is returned with a relative error of
+at most relative_accuracy, independent of the number of values. Two sketches with the same accuracy can
+be merged exactly, which makes it possible to aggregate huge files chunk by chunk.'''
+
+import math
+
+import numpy as np
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy=0.005):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        # bucket index -> count, for the absolute values of positive and negative values
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _add_to_buckets(self, buckets, values):
+        keys, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            buckets[key] = buckets.get(key, 0) + count
+
+    def add(self, values):
+        '''Add an array (or any iterable) of values. NaNs are ignored.'''
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+
+        self.count += values.size
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        self._add_to_buckets(self.positive, values[values > 0])
+        self._add_to_buckets(self.negative, -values[values < 0])
+        self.zeros += int((values == 0).sum())
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Only sketches with the same relative accuracy can be merged.")
+
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_buckets.items():
+                buckets[key] = buckets.get(key, 0) + count
+
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _value(self, key):
+        # the value in the middle of a bucket has at most the relative error relative_accuracy
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def buckets(self):
+        '''Yield (representative value, count) of all buckets in ascending order of the values.'''
+        clamp = lambda value: min(max(value, self.min), self.max)
+        for key in sorted(self.negative, reverse=True):
+            yield clamp(-self._value(key)), self.negative[key]
+        if self.zeros:
+            yield 0.0, self.zeros
+        for key in sorted(self.positive):
+            yield clamp(self._value(key)), self.positive[key]
+
+    def quantile(self, q):
+        '''Estimate the q-quantile (0 <= q <= 1) of the added values.'''
+        if self.count == 0:
+            return math.nan
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, count in self.buckets():
+            seen += count
+            if seen > rank:
+                return value
+        return self.max
+
+    def lowest_at_least(self, threshold):
+        '''The smallest value that is not below threshold (up to the accuracy of the buckets).
+        If it is in the bucket of the minimum, the minimum itself is returned.'''
+        values = [value for value, _ in self.buckets()]
+        for i, value in enumerate(values):
+            if value >= threshold:
+                return self.min if i == 0 else value
+        return self.max
+
+    def highest_at_most(self, threshold):
+        '''The largest value that is not above threshold (up to the accuracy of the buckets).
+        If it is in the bucket of the maximum, the maximum itself is returned.'''
+        values = [value for value, _ in self.buckets()]
+        for i in reversed(range(len(values))):
+            if values[i] <= threshold:
+                return self.max if i == len(values) - 1 else values[i]
+        return self.min
+
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
@@ -0,0 +1,150 @@
+'''Run chopper count on shards of a seqfile list and merge the results.
+The shards are balanced by the total size of their files. Each shard is either run as a local
+process or submitted to a job queue in a shared directory (see job_queue.py) for workers on other nodes.'''
+
+import os
+import re
+import heapq
+import shutil
+import pathlib
+import subprocess
+
+import job_queue
+
+def line_size(line):
+    '''Total size in bytes of the files listed in one line of a seqfile list.'''
+    return sum(os.path.getsize(f) for f in re.split(r"[\t;]", line) if os.path.isfile(f))
+
+def split_into_shards(lines, num_shards):
+    '''Distribute the seqfile lines into num_shards lists with approximately equal total file size.
+    Greedy: the largest remaining line always goes to the currently smallest shard.'''
+    shards = [[] for _ in range(min(num_shards, len(lines)))]
+    heap = [(0, i) for i in range(len(shards))]
+
+    for size, line in sorted(((line_size(line), line) for line in lines), reverse=True):
+        shard_size, i = heapq.heappop(heap)
+        shards[i].append(line)
+        heapq.heappush(heap, (shard_size + size, i))
+
+    return shards
+
+def merge_kmer_counts(shard_count_files, lines, output_file):
+    '''Concatenate the per shard k-mer count files in the order of the original seqfile list.'''
+    order = {line: i for i, line in enumerate(lines)}
+    header, entries = [], []
+
+    for shard_count_file in shard_count_files:
+        with open(shard_count_file, "r") as f:
+            for line in f:
+                if line.startswith("#"):
+                    if line not in header:
+                        header.append(line)
+                    continue
+
+                if line.strip():
+                    key = order.get(line.split("\t")[0], len(order))
+                    entries.append((key, len(entries), line if line.endswith("\n") else line + "\n"))
+
+    with open(output_file, "w+") as f:
+        f.writelines(header)
+        f.writelines(line for _, _, line in sorted(entries))
+
+def merge_hll_dirs(shard_hll_dirs, hll_dir):
+    '''Move the sketches of all shards into the hll directory that chopper pack reads.'''
+    os.makedirs(hll_dir, exist_ok=True)
+
+    for shard_hll_dir in shard_hll_dirs:
+        if not os.path.isdir(shard_hll_dir):
+            continue
+        for filename in os.listdir(shard_hll_dir):
+            if not filename.endswith(".hll"):
+                continue
+            # the hll dir is often on another filesystem, where os.replace fails, so the sketch is moved
+            # (copied if necessary) under a temporary name first and then renamed in place
+            tmp_path = hll_dir / f".{filename}.{os.getpid()}.tmp"
+            shutil.move(shard_hll_dir / filename, tmp_path)
+            os.replace(tmp_path, hll_dir / filename)
+
+def run_sharded_count(count_command, seqfile_list_file, kmer_counts_filename, hll_dir, num_shards, work_dir,
+                      queue_dir=None, local_workers=0, threads=1):
+    '''Run chopper count on num_shards shards of the seqfile list and merge the outputs.
+
+    count_command is the chopper count command without -f, -o, -d and -t. If hll_dir is given, every shard
+    writes its sketches to its own directory and they are merged into hll_dir afterwards.
+    If queue_dir is given, the shards are submitted as jobs to that queue and local_workers
+    workers are started on this machine. Every job may use all threads, because it usually runs on its own node.
+    Else every shard is started as a local process and the threads are divided among them.
+
+    Returns a subprocess.CompletedProcess with the concatenated outputs of all shards.'''
+    with open(seqfile_list_file, "r") as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    shards = split_into_shards(lines, num_shards)
+    os.makedirs(work_dir, exist_ok=True)
+
+    commands, shard_count_files, shard_hll_dirs = [], [], []
+    for i, shard in enumerate(shards):
+        if queue_dir:
+            shard_threads = threads
+        else:
+            # the local shards run at the same time, together they should not use more than the given threads
+            shard_threads = max(1, threads // len(shards) + (i < threads % len(shards)))
+
+        shard_list_file = work_dir / f"shard_{i}_seqfiles.txt"
+        if queue_dir:
+            # a requeued job can run twice at the same time, so every attempt writes to its own directory
+            shard_count_file = pathlib.Path(job_queue.OUTPUT_DIR_PLACEHOLDER) / "kmer_counts.txt"
+            shard_hll_dir = pathlib.Path(job_queue.OUTPUT_DIR_PLACEHOLDER)
+        else:
+            shard_count_file = work_dir / f"shard_{i}_kmer_counts.txt"
+            shard_hll_dir = work_dir / f"shard_{i}_hll"
+
+        with open(shard_list_file, "w+") as f:
+            f.write("\n".join(shard) + "\n")
+
+        command = [str(arg) for arg in count_command] + [
+            "-f", str(shard_list_file), "-o", str(shard_count_file), "-t", str(shard_threads)
+        ]
+        if hll_dir:
+            if not queue_dir:
+                os.makedirs(shard_hll_dir, exist_ok=True)
+            command += ["-d", str(shard_hll_dir)]
+
+        commands.append(command)
+        shard_count_files.append(shard_count_file)
+        shard_hll_dirs.append(shard_hll_dir)
+
+    if queue_dir:
+        job_ids = [job_queue.submit(queue_dir, command, f"count_shard_{i}") for i, command in enumerate(commands)]
+        workers = job_queue.start_local_workers(queue_dir, local_workers)
+        results = job_queue.wait_for(queue_dir, job_ids)
+        for worker in workers:
+            worker.wait()
+
+        # the outputs of the attempts that completed the jobs (jobs that were given up have none)
+        shard_count_files = [result["output_dir"] / "kmer_counts.txt" for result in results if result["output_dir"]]
+        shard_hll_dirs = [result["output_dir"] for result in results if result["output_dir"]]
+
+    else:
+        procs = [
+            subprocess.Popen(command, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            for command in commands
+        ]
+        results = []
+        for proc in procs:
+            stdout, stderr = proc.communicate()
+            results.append({"returncode": proc.returncode, "stdout": stdout, "stderr": stderr})
+
+    stdout, stderr = "", ""
+    for i, result in enumerate(results):
+        stdout += f"---------- shard {i} ({len(shards[i])} files) ----------\n{result['stdout']}"
+        stderr += f"---------- shard {i} ({len(shards[i])} files) ----------\n{result['stderr']}"
+
+    returncode = max((abs(result["returncode"]) for result in results), default=0)
+
+    if returncode == 0:
+        merge_kmer_counts(shard_count_files, lines, kmer_counts_filename)
+        if hll_dir:
+            merge_hll_dirs(shard_hll_dirs, hll_dir)
+
+    return subprocess.CompletedProcess(commands, returncode, stdout, stderr)